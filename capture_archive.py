@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Compressed capture archive with random access
+
+Raw ADC codes of each channel are split into fixed-size chunks which are
+compressed independently and in parallel on a thread pool (zlib, lzma and
+bz2 all release the GIL). A chunk offset index at the end of the file allows
+decompressing only the chunks covering a requested sample or time window.
+
+File layout:
+    b"HDSCAP01"
+    compressed chunks, channel by channel
+    JSON index and metadata
+    footer: uint64 offset of the JSON index, b"HDSCAP01"
+"""
+import bz2
+import json
+import lzma
+import os
+import struct
+import threading
+import zlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+MAGIC = b"HDSCAP01"
+_footer = struct.Struct("<Q8s")
+
+# Codec name: (compress(data, level), decompress(data))
+CODECS = {
+        "zlib": (lambda data, level: zlib.compress(data, level),
+                 zlib.decompress),
+        "lzma": (lambda data, level: lzma.compress(data, preset=level),
+                 lzma.decompress),
+        "bz2": (lambda data, level: bz2.compress(data, max(level, 1)),
+                bz2.decompress),
+        }
+
+
+def write_capture(path, channels, gains=None, offsets=None,
+                  sample_rates=None, t0s=None, names=None, codec="zlib",
+                  level=3, chunk_size=2**20, max_workers=None):
+    """Write raw codes of several channels into a compressed capture archive.
+
+    channels:       Sequence of per-channel raw code vectors
+    gains, offsets: Per-channel scaling, physical = raw*gain + offset
+    sample_rates:   Per-channel sample rate in samples per second
+    t0s:            Per-channel time of first sample relative to trigger
+    names:          Per-channel names identifying the source, e.g. "CH2".
+                    Default: "CH1", "CH2"... in order of channels.
+    codec:          One of CODECS
+    chunk_size:     Number of samples per independently compressed chunk
+    max_workers:    Number of compression threads, default: CPU count
+    """
+    n = len(channels)
+    gains = [1.0] * n if gains is None else gains
+    offsets = [0.0] * n if offsets is None else offsets
+    sample_rates = [1.0] * n if sample_rates is None else sample_rates
+    t0s = [0.0] * n if t0s is None else t0s
+    names = [f"CH{i+1}" for i in range(n)] if names is None else names
+    compress = CODECS[codec][0]
+    index = {"codec": codec, "chunk_size": chunk_size, "channels": []}
+    with open(path, "wb") as f, ThreadPoolExecutor(max_workers) as executor:
+        f.write(MAGIC)
+        for i, raw in enumerate(channels):
+            raw = np.ascontiguousarray(raw)
+            # Memoryviews of the chunks, the input is not copied
+            chunks = [memoryview(raw[start:start+chunk_size]).cast("B")
+                      for start in range(0, raw.size, chunk_size)]
+            chunk_index = []
+            # Results come back in order while later chunks are compressed
+            for data in executor.map(compress, chunks, [level]*len(chunks)):
+                chunk_index.append((f.tell(), len(data)))
+                f.write(data)
+            index["channels"].append({
+                    "name": str(names[i]),
+                    "dtype": raw.dtype.str,
+                    "n_samples": raw.size,
+                    "gain": float(gains[i]),
+                    "offset": float(offsets[i]),
+                    "sample_rate": float(sample_rates[i]),
+                    "t0": float(t0s[i]),
+                    "chunks": chunk_index,
+                    })
+        index_offset = f.tell()
+        f.write(json.dumps(index).encode())
+        f.write(_footer.pack(index_offset, MAGIC))
+
+
+class CaptureArchive():
+    """Random access reader for files written by write_capture().
+
+    Init args:
+    path:           File name
+    max_workers:    Number of decompression threads, default: CPU count
+    """
+    def __init__(self, path, max_workers=None):
+        self._file = open(path, "rb")
+        self._lock = threading.Lock()
+        self._file.seek(-_footer.size, os.SEEK_END)
+        end = self._file.tell()
+        index_offset, magic = _footer.unpack(self._file.read(_footer.size))
+        assert magic == MAGIC, "Not a hdscope capture archive"
+        self._file.seek(index_offset)
+        index = json.loads(self._file.read(end - index_offset))
+        self.codec = index["codec"]
+        self.chunk_size = index["chunk_size"]
+        self.channels = index["channels"]
+        # Archives written before channel names were stored
+        self.names = [meta.get("name", f"CH{i+1}")
+                      for i, meta in enumerate(self.channels)]
+        self._decompress = CODECS[self.codec][1]
+        self._executor = ThreadPoolExecutor(max_workers)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _index(self, ch):
+        """Channel index from an index or a channel name"""
+        return self.names.index(ch) if isinstance(ch, str) else ch
+
+    def _read_chunk(self, ch, k):
+        offset, length = self.channels[ch]["chunks"][k]
+        with self._lock:
+            self._file.seek(offset)
+            data = self._file.read(length)
+        return self._decompress(data)
+
+    def read(self, ch, start=0, stop=None):
+        """Returns raw codes of channel ch (index or name) for the sample
+        index range start...stop-1. Only chunks covering this range are
+        decompressed.
+        """
+        ch = self._index(ch)
+        meta = self.channels[ch]
+        n_samples = meta["n_samples"]
+        stop = n_samples if stop is None else min(stop, n_samples)
+        start = min(max(start, 0), stop)
+        out = np.empty(stop - start, dtype=np.dtype(meta["dtype"]))
+        if out.size == 0:
+            return out
+        first = start // self.chunk_size
+        last = (stop - 1) // self.chunk_size
+        chunk_ids = range(first, last + 1)
+        blocks = self._executor.map(self._read_chunk, [ch]*len(chunk_ids),
+                                    chunk_ids)
+        for k, data in zip(chunk_ids, blocks):
+            block = np.frombuffer(data, dtype=out.dtype)
+            chunk_start = k * self.chunk_size
+            lo = max(start, chunk_start)
+            hi = min(stop, chunk_start + block.size)
+            out[lo-start:hi-start] = block[lo-chunk_start:hi-chunk_start]
+        return out
+
+    def read_physical(self, ch, start=0, stop=None, dtype=np.float64):
+        """Same as read(), but scaled to physical units of floating point
+        type dtype, e.g. Config.float_precision"""
+        ch = self._index(ch)
+        meta = self.channels[ch]
+        raw = self.read(ch, start, stop)
+        samples = np.empty(raw.size, dtype=dtype)
+        # In-place operations, no full-length temporaries
+        np.multiply(raw, meta["gain"], out=samples, casting="same_kind")
+        samples += meta["offset"]
+        return samples
+
+    def read_time(self, ch, t_start, t_stop, dtype=np.float64):
+        """Returns time and physical sample vectors of channel ch (index or
+        name) for the time span t_start...t_stop relative to the trigger.
+        Samples are of floating point type dtype, times are float64.
+        """
+        ch = self._index(ch)
+        meta = self.channels[ch]
+        sample_rate, t0 = meta["sample_rate"], meta["t0"]
+        start = max(int(np.ceil((t_start - t0) * sample_rate)), 0)
+        stop = int(np.floor((t_stop - t0) * sample_rate)) + 1
+        samples = self.read_physical(ch, start, stop, dtype)
+        time = t0 + (start + np.arange(samples.size)) / sample_rate
+        return time, samples
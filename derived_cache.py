@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of filtered and other derived channel data
+
+Keys are tuples starting with the acquisition id, e.g.
+(acq_id, channel, filter function, parameters...). Entries are evicted in
+least-recently-used order when the total size exceeds a byte limit.
+"""
+import sys
+import threading
+from collections import OrderedDict
+
+
+def nbytes(value):
+    """Memory size of numpy arrays, tuples or lists thereof"""
+    if hasattr(value, "nbytes"):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(i) for i in value)
+    return sys.getsizeof(value)
+
+
+class DerivedDataCache():
+    """Byte-size bounded LRU cache.
+
+    Init args:
+    max_bytes:  Upper limit of the summed size of all cached values. Values
+                larger than this are not cached at all.
+
+    Public members:
+    hits, misses, evictions:    Statistics since creation or reset_stats()
+    """
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hit_rate(self):
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = nbytes(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute):
+        """Returns the cached value for key, or calls compute() on a miss
+        and caches its result.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def invalidate(self, acq_id=None):
+        """Remove all entries, or those of one acquisition id only"""
+        with self._lock:
+            if acq_id is None:
+                self._entries.clear()
+                self.n_bytes = 0
+                return
+            for key in [i for i in self._entries if i[0] == acq_id]:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.n_bytes -= entry[1]
+
+    def stats(self):
+        return {
+                "entries": len(self._entries),
+                "bytes": self.n_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hit_rate,
+                }
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+"""
+Fast QPainter plot widget for continuous acquisition
+
+Drop-in alternative to MplWidget. Each trace has a pre-allocated QPolygonF
+vertex buffer which is updated in place through a numpy view, after min/max
+decimation of the visible window to the widget width. Zooming and cursor
+movement only change the painter transform, not the vertex data.
+"""
+import numpy as np
+from PyQt5.QtCore import Qt, QPointF, QRect, QRectF
+from PyQt5.QtGui import (QPainter, QPen, QColor, QPolygonF, QTransform,
+                         QImage, qRgb)
+from PyQt5.QtWidgets import QToolBar, QRubberBand
+from plotwidget import PlotWidgetBase
+import filters
+
+# Same as the matplotlib default color cycle
+TRACE_COLORS = ("#1f77b4", "#ff7f0e", "#2ca02c", "#d62728",
+                "#9467bd", "#8c564b", "#e377c2", "#7f7f7f")
+# Persistence display: white background, then light yellow to dark red
+DENSITY_COLORS = [qRgb(255, 255, 255)] + [
+        qRgb(255 - i//4, 240 - (i*9)//10, 160 - (i*5)//8) for i in range(1, 256)]
+
+
+class TraceBuffer():
+    """Pre-allocated vertex buffer of one trace.
+
+    xy is a (n_points_max, 2) numpy view on the QPolygonF memory, i.e. writing
+    to xy updates the polygon without any Python objects per vertex.
+    """
+    def __init__(self, n_points_max):
+        self.polygon = QPolygonF()
+        self.polygon.fill(QPointF(), n_points_max)
+        buffer = self.polygon.data()
+        buffer.setsize(2 * n_points_max * np.dtype(np.float64).itemsize)
+        self.xy = np.frombuffer(buffer, dtype=np.float64).reshape(-1, 2)
+        self._index = np.arange(n_points_max, dtype=np.float64)
+        self.n_points = 0
+
+    def set_data(self, x0, dx, y):
+        """Set vertices to an equidistant time base x0 + k*dx"""
+        n = min(y.size, self.xy.shape[0])
+        np.multiply(self._index[:n], dx, out=self.xy[:n, 0])
+        self.xy[:n, 0] += x0
+        self.xy[:n, 1] = y[:n]
+        # Unused vertices collapse onto the last point
+        if 0 < n < self.xy.shape[0]:
+            self.xy[n:] = self.xy[n-1]
+        self.n_points = n
+
+
+class FastCursor():
+    """Measurement cursor with the same semantics as mplwidget.Cursor.
+
+    A vertical cursor is a horizontal line measuring the vertical axis and
+    vice versa.
+    """
+    def __init__(self,
+            plot_widget,
+            callback=lambda *x: None, # E.g. QCheckBox setChecked method
+            name="v1", # "vertical measurement cursor 1"
+            is_vertical=True,
+            linestyle=Qt.DashLine,
+            ):
+        self.plot_widget = plot_widget
+        self.callback = callback
+        self.name = name
+        self.is_vertical = is_vertical
+        self.linestyle = linestyle
+        self.position = 0.0
+        self.is_active = False
+
+    def set_enabled(self, activation):
+        "Show cursor if activation argument is true, else remove cursor"
+        self.is_active = bool(activation)
+        self.callback(self.is_active)
+        self.plot_widget.update()
+
+    def restore(self):
+        self.set_enabled(self.is_active)
+
+    def move(self, x, y):
+        self.position = y if self.is_vertical else x
+
+    def pixel_distance(self, transform, pos):
+        point = transform.map(QPointF(self.position, self.position))
+        if self.is_vertical:
+            return abs(point.y() - pos.y())
+        return abs(point.x() - pos.x())
+
+
+class FastPlotWidget(PlotWidgetBase):
+    """QPainter plot widget with the MplWidget interface.
+
+    Init args:
+    n_points_max:   Vertex buffer size per trace. Visible samples beyond this
+                    are min/max decimated to at most one pair per pixel column.
+    n_traces:       Number of pre-allocated traces
+    """
+    cursor_selected = None
+    # Pick radius for cursors in pixels
+    pick_radius = 5.0
+    # Maximum number of annotations drawn, these are drawn per item
+    n_annotations_max = 1000
+
+    def __init__(self, parent=None, n_points_max=4096, n_traces=4):
+        super().__init__(parent)
+        self.traces = [TraceBuffer(n_points_max) for i in range(n_traces)]
+        self.pens = []
+        for i in range(n_traces):
+            pen = QPen(QColor(TRACE_COLORS[i % len(TRACE_COLORS)]))
+            # Line width independent of the zoom transform
+            pen.setCosmetic(True)
+            self.pens.append(pen)
+        self.time_span = 1.0
+        self.channels = []
+        self.ydata = []
+        # Per-trace (sample rate, t0), None if all traces span time_span
+        self.time_bases = None
+        # Persistence image and extent (x0, x1, y0, y1), None if disabled
+        self.density_image = None
+        self.density_extent = None
+        # Protocol annotations: start times, stop times, texts, y position
+        self.annotations = None
+        # Visible data range x0, x1, y0, y1
+        self.view = [0.0, 1.0, -1.0, 1.0]
+        self.zoomed = False
+        self.mode = None # None, "zoom" or "pan"
+        self._drag_start = None
+        self._drag_view = None
+        self.rubber_band = QRubberBand(QRubberBand.Rectangle, self)
+        self.cursors = [
+                FastCursor(self, name="Hor. Cursor 1",
+                    is_vertical=False, linestyle=Qt.DashLine),
+                FastCursor(self, name="Hor. Cursor 2",
+                    is_vertical=False, linestyle=Qt.DashDotLine),
+                FastCursor(self, name="Vert. Cursor 1",
+                    is_vertical=True, linestyle=Qt.DashLine),
+                FastCursor(self, name="Vert. Cursor 2",
+                    is_vertical=True, linestyle=Qt.DashDotLine),
+                ]
+        self.setMouseTracking(True)
+        self.setAttribute(Qt.WA_OpaquePaintEvent)
+        self.setMinimumSize(200, 150)
+
+    def plot_new(self, time_span, channels, ydata, time_bases=None):
+        self.time_span = time_span
+        self.channels = channels
+        self.ydata = ydata
+        self.time_bases = time_bases
+        if not self.zoomed:
+            self.view[0:2] = self._time_range()
+        self._update_traces()
+        if not self.zoomed:
+            self._autoscale_y()
+        for i in self.cursors:
+            i.restore()
+        self.update()
+
+    def plot_density(self, image, extent):
+        if image is None:
+            self.density_image = None
+            self.update()
+            return
+        # Image rows top-down, i.e. highest amplitude first. QImage does not
+        # copy, so the array is kept referenced here.
+        self._density_array = np.ascontiguousarray(image[::-1])
+        height, width = self._density_array.shape
+        self.density_image = QImage(self._density_array.data, width, height,
+                                    width, QImage.Format_Indexed8)
+        self.density_image.setColorTable(DENSITY_COLORS)
+        self.density_extent = extent
+        self.update()
+
+    def plot_annotations(self, t_start, t_stop, text, y):
+        self.annotations = (t_start, t_stop, text, y) if len(t_start) else None
+        self.update()
+
+    def home(self):
+        self.zoomed = False
+        self.view[0:2] = self._time_range()
+        self._update_traces()
+        self._autoscale_y()
+        self.update()
+
+    def make_toolbar(self, parent):
+        toolbar = QToolBar("Plot", parent)
+        toolbar.addAction("Home", self.home)
+        self.action_zoom = toolbar.addAction("Zoom")
+        self.action_zoom.setCheckable(True)
+        self.action_zoom.toggled.connect(lambda on: self._set_mode("zoom", on))
+        self.action_pan = toolbar.addAction("Pan")
+        self.action_pan.setCheckable(True)
+        self.action_pan.toggled.connect(lambda on: self._set_mode("pan", on))
+        return toolbar
+
+    def _set_mode(self, mode, enabled):
+        if enabled:
+            self.mode = mode
+            # Zoom and pan are mutually exclusive
+            other = self.action_pan if mode == "zoom" else self.action_zoom
+            other.setChecked(False)
+        elif self.mode == mode:
+            self.mode = None
+
+    def _active_ydata(self):
+        for i, y in enumerate(self.ydata[:len(self.traces)]):
+            active = self.channels[i] if i < len(self.channels) else True
+            if active and len(y) > 1:
+                yield i, y
+
+    def _time_base(self, i, y):
+        """Returns (time of first sample, sample interval) of trace i"""
+        if self.time_bases is None:
+            return 0.0, self.time_span / len(y)
+        sample_rate, t0 = self.time_bases[i]
+        return t0, 1.0 / sample_rate
+
+    def _time_range(self):
+        """Time span covering all active traces"""
+        spans = []
+        for i, y in self._active_ydata():
+            t0, dt = self._time_base(i, y)
+            spans.append((t0, t0 + len(y) * dt))
+        if not spans:
+            return [0.0, self.time_span]
+        return [min(i[0] for i in spans), max(i[1] for i in spans)]
+
+    def _update_traces(self):
+        """Decimate the visible window of each trace into its vertex buffer"""
+        x0, x1 = self.view[0:2]
+        for trace in self.traces:
+            trace.n_points = 0
+        for i, y in self._active_ydata():
+            trace = self.traces[i]
+            t0, dt = self._time_base(i, y)
+            start = int(np.clip(np.floor((x0 - t0) / dt), 0, len(y)))
+            stop = int(np.clip(np.ceil((x1 - t0) / dt) + 1, start, len(y)))
+            n_buckets = min(trace.xy.shape[0] // 2, max(self.width(), 1))
+            if stop - start <= 2 * n_buckets:
+                segment = y[start:stop]
+                dx = dt
+            elif hasattr(y, "evaluate_minmax"):
+                # Math channel, decimated while evaluating the visible window
+                segment, factor = y.evaluate_minmax(start, stop, n_buckets)
+                dx = factor * dt / 2
+            else:
+                factor = -(-(stop - start) // n_buckets)
+                segment = filters.downsample_minmax(y[start:stop], factor)
+                dx = factor * dt / 2
+            trace.set_data(t0 + start * dt, dx, segment)
+
+    def _autoscale_y(self):
+        ranges = [(t.xy[:t.n_points, 1].min(), t.xy[:t.n_points, 1].max())
+                  for t in self.traces if t.n_points > 0]
+        if not ranges:
+            return
+        y0 = min(i[0] for i in ranges)
+        y1 = max(i[1] for i in ranges)
+        margin = 0.05 * (y1 - y0) if y1 > y0 else 1.0
+        self.view[2:4] = [y0 - margin, y1 + margin]
+
+    def _transform(self):
+        """Data coordinates to pixel coordinates"""
+        x0, x1, y0, y1 = self.view
+        sx = self.width() / (x1 - x0)
+        sy = self.height() / (y1 - y0)
+        return QTransform(sx, 0.0, 0.0, -sy, -sx*x0, self.height() + sy*y0)
+
+    def _to_data(self, pos):
+        point = self._transform().inverted()[0].map(QPointF(pos))
+        return point.x(), point.y()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.white)
+        if self.density_image is not None:
+            x0, x1, y0, y1 = self.density_extent
+            target = self._transform().mapRect(QRectF(x0, y0, x1-x0, y1-y0))
+            painter.drawImage(target, self.density_image)
+        self._draw_grid(painter)
+        painter.setTransform(self._transform())
+        for trace, pen in zip(self.traces, self.pens):
+            if trace.n_points > 0:
+                painter.setPen(pen)
+                painter.drawPolyline(trace.polygon)
+        x0, x1, y0, y1 = self.view
+        for cursor in self.cursors:
+            if not cursor.is_active:
+                continue
+            pen = QPen(Qt.black, 1.5, cursor.linestyle)
+            pen.setCosmetic(True)
+            painter.setPen(pen)
+            p = cursor.position
+            if cursor.is_vertical:
+                painter.drawLine(QPointF(x0, p), QPointF(x1, p))
+            else:
+                painter.drawLine(QPointF(p, y0), QPointF(p, y1))
+        painter.resetTransform()
+        self._draw_annotations(painter)
+        self._draw_labels(painter)
+        painter.end()
+
+    def _draw_grid(self, painter):
+        # Oscilloscope style: 10 horizontal by 8 vertical divisions
+        painter.setPen(QPen(QColor("#dddddd"), 1, Qt.DotLine))
+        w, h = self.width(), self.height()
+        for i in range(1, 10):
+            painter.drawLine(i*w//10, 0, i*w//10, h)
+        for i in range(1, 8):
+            painter.drawLine(0, i*h//8, w, i*h//8)
+
+    def _draw_annotations(self, painter):
+        if self.annotations is None:
+            return
+        t_start, t_stop, text, y = self.annotations
+        x0, x1 = self.view[0:2]
+        # Visible annotations only, found by binary search
+        a = max(np.searchsorted(t_stop, x0) - 1, 0)
+        b = min(np.searchsorted(t_start, x1), a + self.n_annotations_max)
+        transform = self._transform()
+        y_pixel = transform.map(QPointF(0.0, y)).y()
+        painter.setPen(QPen(Qt.black))
+        for i in range(a, b):
+            left = transform.map(QPointF(t_start[i], y)).x()
+            right = transform.map(QPointF(t_stop[i], y)).x()
+            rect = QRectF(left, y_pixel - 8, max(right - left, 1.0), 16)
+            painter.drawRect(rect)
+            # Text only if there is room for it
+            if rect.width() > 6 * len(text[i]):
+                painter.drawText(rect, Qt.AlignCenter, str(text[i]))
+
+    def _draw_labels(self, painter):
+        x0, x1, y0, y1 = self.view
+        painter.setPen(Qt.darkGray)
+        w, h = self.width(), self.height()
+        flags_left = Qt.AlignLeft | Qt.AlignBottom
+        flags_right = Qt.AlignRight | Qt.AlignBottom
+        painter.drawText(QRect(4, 0, w-8, h-4), flags_left, f"{x0:.6g} s")
+        painter.drawText(QRect(4, 0, w-8, h-4), flags_right, f"{x1:.6g} s")
+        painter.drawText(QRect(4, 4, w-8, h), Qt.AlignLeft | Qt.AlignTop,
+                         f"{y1:.4g}")
+        painter.drawText(QRect(4, 0, w-8, h-20), flags_left, f"{y0:.4g}")
+
+    def resizeEvent(self, event):
+        # Decimation depends on the number of pixel columns
+        self._update_traces()
+        super().resizeEvent(event)
+
+    def wheelEvent(self, event):
+        # Horizontal zoom around the mouse position
+        x, _ = self._to_data(event.pos())
+        factor = 0.8 if event.angleDelta().y() > 0 else 1.25
+        x0, x1 = self.view[0:2]
+        self.view[0:2] = [x - (x - x0)*factor, x + (x1 - x)*factor]
+        self.zoomed = True
+        self._update_traces()
+        self.update()
+
+    def mousePressEvent(self, event):
+        pos = event.pos()
+        if self.mode == "zoom":
+            self._drag_start = pos
+            self.rubber_band.setGeometry(QRect(pos, pos))
+            self.rubber_band.show()
+        elif self.mode == "pan":
+            self._drag_start = pos
+            self._drag_view = list(self.view)
+        else:
+            self._pick_cursor(pos)
+
+    def _pick_cursor(self, pos):
+        transform = self._transform()
+        for cursor in self.cursors:
+            if (not cursor.is_active
+                    or cursor.pixel_distance(transform, pos) > self.pick_radius):
+                continue
+            # Toggle. Ignore further cursors inside the pick radius, same as
+            # the MplWidget implementation.
+            if self.cursor_selected is None:
+                self.cursor_selected = cursor
+                print(f"Selected cursor: {cursor.name}")
+            elif self.cursor_selected is cursor:
+                print(f"Cursor deactivated: {cursor.name}")
+                self.cursor_selected = None
+            return
+
+    def mouseMoveEvent(self, event):
+        pos = event.pos()
+        if self.mode == "zoom" and self._drag_start is not None:
+            self.rubber_band.setGeometry(
+                    QRect(self._drag_start, pos).normalized())
+        elif self.mode == "pan" and self._drag_start is not None:
+            x0, x1, y0, y1 = self._drag_view
+            dx = (pos.x() - self._drag_start.x()) * (x1 - x0) / self.width()
+            dy = (pos.y() - self._drag_start.y()) * (y1 - y0) / self.height()
+            self.view = [x0 - dx, x1 - dx, y0 + dy, y1 + dy]
+            self.zoomed = True
+            self._update_traces()
+            self.update()
+        elif self.cursor_selected is not None:
+            self.cursor_selected.move(*self._to_data(pos))
+            self.update()
+
+    def mouseReleaseEvent(self, event):
+        if self.mode == "zoom" and self._drag_start is not None:
+            self.rubber_band.hide()
+            rect = QRect(self._drag_start, event.pos()).normalized()
+            if rect.width() > 2 and rect.height() > 2:
+                xa, ya = self._to_data(rect.topLeft())
+                xb, yb = self._to_data(rect.bottomRight())
+                self.view = [xa, xb, yb, ya]
+                self.zoomed = True
+                self._update_traces()
+                self.update()
+        self._drag_start = None
@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 """
 Basic signal processing
+
+Results have the floating point type of the input, i.e. float32 samples are
+processed and returned as float32. Other inputs give float64 results.
 """
 import sys
 import numpy as np
 import pandas as pd
 import scipy.signal
 
+def _float_type(x):
+    return x.dtype if np.issubdtype(x.dtype, np.floating) else np.float64
+
 def downsample_average(x, N):
     """Downsample using simple average as anti-aliasing filter.
     
@@ -20,23 +26,49 @@ def downsample_average(x, N):
     assert x.size % N == 0, "Input vector must be divisible by N"
     return np.mean(x.reshape(-1, N), axis=1)
 
-def moving_average1(x, N):
-    # Fast. Processing 100 megasample float values needs approx. 4 GiB RAM.
-    # See: https://stackoverflow.com/a/27681394/675674
-    cumsum = np.cumsum(np.insert(x, 0, 0)) 
-    return (cumsum[N:] - cumsum[:-N]) / float(N)
+def moving_average1(x, N, chunk_size=2**20):
+    # Fast. See: https://stackoverflow.com/a/27681394/675674
+    # Running sums are accumulated in float64 and restart at zero for each
+    # chunk, so rounding errors do not grow with the record length, even for
+    # float32 input. Temporaries are chunk-sized, RAM usage is the output only.
+    n_out = max(x.size - N + 1, 0)
+    out = np.empty(n_out, dtype=_float_type(x))
+    cumsum = np.zeros(chunk_size + N, dtype=np.float64)
+    diff = np.empty(chunk_size, dtype=np.float64)
+    for start in range(0, n_out, chunk_size):
+        stop = min(start + chunk_size, n_out)
+        n = stop - start
+        np.cumsum(x[start:stop+N-1], dtype=np.float64, out=cumsum[1:n+N])
+        np.subtract(cumsum[N:n+N], cumsum[:n], out=diff[:n])
+        np.divide(diff[:n], N, out=out[start:stop], casting="same_kind")
+    return out
 
 def moving_average2(x, N):
     # Uses convolution. Approx. 10x slower than np.cumsums but uses less
     # memory: approx. 2.5 GiB for 100 megasamples.
-    return np.convolve(x, np.ones((N,))/N, mode="valid")
+    return np.convolve(x, np.ones((N,), dtype=_float_type(x))/N, mode="valid")
     
 def moving_average3(x, N):
     # Uses convolution via FFT and IFFT. Similar speed than np.convolve but
     # much more memory usage, approx. 8.5 GiB for 100 megasamples.
-    return scipy.signal.fftconvolve(x, np.ones((N,))/N, mode="valid")
+    return scipy.signal.fftconvolve(
+            x, np.ones((N,), dtype=_float_type(x))/N, mode="valid")
     
 def moving_average4(x, N):
     # Using pandas, approx. 4x slower than np.cumsum. Approx. 8 GiB for 100
-    # megasamples.
-    return pd.Series(x).rolling(window=N).mean().iloc[N-1:].values
+    # megasamples. Pandas computes in float64.
+    rolling = pd.Series(x).rolling(window=N).mean().iloc[N-1:].values
+    return rolling.astype(_float_type(x), copy=False)
+
+def downsample_minmax(x, N):
+    """Downsample for display, keeping the minimum and maximum of each
+    interval of N samples in alternating order.
+
+    Unlike averaging, this preserves glitches and the signal envelope.
+    Returns 2*(x.size//N) samples, trailing samples are discarded.
+    """
+    blocks = x[:x.size//N*N].reshape(-1, N)
+    out = np.empty((blocks.shape[0], 2), dtype=x.dtype)
+    np.min(blocks, axis=1, out=out[:, 0])
+    np.max(blocks, axis=1, out=out[:, 1])
+    return out.reshape(-1)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import sys
+import time
 import random
 import atexit
 import numpy as np
@@ -8,11 +9,21 @@ from functools import partial
 from PyQt5.QtCore import QThread, pyqtSignal
 from PyQt5.QtWidgets import QMainWindow, QApplication
 import PyQt5.uic
-from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as MplToolbar
 # "from python-ivi import ivi" does not work since python-ivi has dash in name
 import importlib
 ivi = importlib.import_module("python-ivi.ivi")
 import filters
+import scope_drivers
+import interpolation
+import shm_publish
+import persistence
+import mask_test
+import capture_archive
+import derived_cache
+import protocol_decode
+import math_channels
+import mplwidget
+import fastplotwidget
 
 if "get_ipython" in globals():
     get_ipython().run_line_magic("gui", "qt5")
@@ -21,6 +32,9 @@ if "get_ipython" in globals():
 
 class Config():
     driver_class = ivi.rigol.rigolDS1104Z
+    # Native binary waveform download, see scope_drivers.py.
+    # If set to None, python-ivi fetch_waveform() is used as a fallback.
+    native_driver_class = scope_drivers.RigolDS1000Z
     ip_addr = "169.254.11.120"
     tcp_port = "5555"
     n_channels = 4
@@ -49,23 +63,50 @@ class Config():
     mdepth_max = max(mdepth_opts.values())
     # 1 GS/s default
     sample_rate_default = 1000000000
-    # Set numpy float precision.
+    # Set numpy float precision for channel buffers, filters, interpolation
+    # and shared memory publishing. np.float32 halves RAM and bandwidth.
     # Beware 100 Megasamples is 800 Megabytes RAM at 64 bit.
-    # Filters typically need another three to six times the per-channel RAM
+    # Filters typically need another one to six times the per-channel RAM
     float_precision = np.float64
     # FIR filter kernel length
     filter_length = 120
     # Default filter setting
     filter_chain = filters.moving_average1
+    # Size limit of the cache for filtered and other derived channel data
+    derived_cache_bytes = 2 * 1024**3
+    # sin(x)/x interpolation kernel half length in samples
+    interp_half_length = 16
+    # Maximum interpolation factor when zooming in beyond 1 sample per pixel
+    upsample_max = 64
+    # Base name of shared memory segments for publishing each acquisition to
+    # external processes, see shm_publish.py. None disables publishing.
+    # Beware this takes another 2*n_channels*mdepth_max samples of RAM.
+    shm_name = None
+    # Plot widget implementation, see plotwidget.py. For continuous
+    # acquisition, fastplotwidget.FastPlotWidget is built for high frame rates.
+    plot_widget_class = mplwidget.MplWidget
+    # Persistence display resolution (time pixels, amplitude pixels)
+    density_shape = (1000, 256)
+    # Persistence decay factor per frame, 1.0 is infinite persistence
+    density_decay = 1.0
+    # Mask test envelope files (see mask_test.MaskTest.save) by channel index,
+    # e.g. {0: "mask_ch1.npz"}. Empty dict disables mask testing.
+    mask_files = {}
+    # Directory for saving raw codes of failing frames, None to not save
+    mask_save_dir = None
+    # Math channels by name, e.g. {"P": "CH1*CH2", "I": "(CH3-CH4)*0.1"}.
+    # Evaluated lazily, see math_channels.py.
+    math_channels = {}
 
 
 class AnalogChannel():
     def __init__(
             self,
             ivi_driver,
-            ch_buffer, # Call by reference
+            ch_buffers, # Call by reference
             ch_active_flags, # Call by reference
             index=0,
+            native_driver=None,
             active_on_start=True,
             desc="Channel xyz",
             unit="V",
@@ -80,17 +121,31 @@ class AnalogChannel():
             impedance="1000000",
             ):
         self.ivi_driver = ivi_driver
-        self.ch_buffer = ch_buffer
+        self.native_driver = native_driver
+        self.ch_buffers = ch_buffers
+        # Pre-allocated buffer of maximum length, re-used for native download
+        self.ch_buffer_max = ch_buffers[index]
+        # Raw ADC codes and (gain, offset) of the last native download.
+        # Raw codes are None when using the python-ivi fallback.
+        self.raw = None
+        self.raw_scaling = (1.0, 0.0)
+        if native_driver is not None:
+            self.raw_buffer_max = np.empty(self.ch_buffer_max.size,
+                                           dtype=native_driver.raw_dtype)
+        self.ch_active_flags = ch_active_flags
         self.ch_active_flags[index] = active_on_start # Assign to reference
         self.index = index
         self.desc = desc
         self.invert = invert
         self.scale = scale
         self.probe_atten = probe_atten
-        self.offset = ofset
+        self.offset = offset
         self.unit = unit
         self.bw_limit_max = bw_limit_max
         self.time_skew = time_skew
+        # Part of time_skew applied by the hardware (probe_skew), as read
+        # back from the instrument. The rest is deskewed in software.
+        self.hw_time_skew = 0.0
         self.coupling = coupling
         self.impedance = impedance
 
@@ -105,6 +160,7 @@ class AnalogChannel():
         self.offset = ch_drv.offset
         self.bw_limit_max = ch_drv.input_frequency_max
         self.time_skew = ch_drv.probe_skew
+        self.hw_time_skew = self.time_skew
         self.coupling = ch_drv.coupling
         self.impedance = ch_drv.input_impedance
     def push_hw_props(self):
@@ -118,20 +174,42 @@ class AnalogChannel():
         ch_drv.offset = self.offset
         ch_drv.input_frequency_max = self.bw_limit_max
         ch_drv.probe_skew = self.time_skew
+        # The hardware may quantize or limit the skew
+        self.hw_time_skew = ch_drv.probe_skew
         ch_drv.coupling = self.coupling
         ch_drv.input_impedance = self.impedance
 
-    def pull_samples(self):
+    @property
+    def residual_skew(self):
+        """Skew in seconds not applied by the hardware, i.e. to be applied
+        in software. A positive skew means the signal arrives late."""
+        return self.time_skew - self.hw_time_skew
+
+    def pull_samples(self, n_samples):
         """Pull acquired samples from hardware if available.
         This is a non-blocking method. Returns "True" if data was read.
+
+        With a native driver, samples are downloaded in binary format directly
+        into the pre-allocated channel buffer. Otherwise, this falls back to
+        python-ivi fetch_waveform(), which is slow for large n_samples.
         """
         drv = self.ivi_driver
         # FIXME: Measurement status != acquisition status?!
         if drv.measurement.status == "complete": 
             # Assign to reference
-            self.ch_buffer[self.index] = np.array(
-                    drv.channels[self.index].fetch_waveform().y
-                    )
+            if self.native_driver is not None:
+                # Hardware channel numbers are 1-based
+                native = self.native_driver
+                self.raw = native.read_raw(
+                        self.index+1, n_samples, out=self.raw_buffer_max)
+                self.raw_scaling = native.get_scaling(self.index+1)
+                self.ch_buffers[self.index] = native.scale_samples(
+                        self.raw, *self.raw_scaling, out=self.ch_buffer_max)
+            else:
+                self.ch_buffers[self.index] = np.array(
+                        drv.channels[self.index].fetch_waveform().y,
+                        dtype=self.ch_buffer_max.dtype,
+                        )
             return True
         else:
             return False
@@ -161,18 +239,29 @@ class HardwareInterface():
                 pyvisa_opts={"read_termination":"\n", "write_termination":"\n"},
                 prefer_pyvisa=True,
                 )
+        # python-ivi is used for settings, waveform download is native
+        if config.native_driver_class is not None:
+            self.native_driver = config.native_driver_class.from_ivi_driver(
+                    self.scope, config.n_channels)
+        else:
+            self.native_driver = None
         self.n_channels = config.n_channels
         self.ch_active_flags = config.ch_active_flags
         self.sample_rate = config.sample_rate_default
         self.mdepth = config.mdepth_default
+        # Time of the first sample relative to the trigger, negative for
+        # pre-trigger samples
+        self.start_time = 0.0
         # Buffer is handed over from the data model
         self.ch_buffers = ch_buffers
         # Analog channel objects for channel-by-channel hardware interaction
         self.ch = [
                 AnalogChannel(
                     ivi_driver=self.scope,
-                    ch_buffer=self.ch_buffers[i],
+                    ch_buffers=self.ch_buffers,
+                    ch_active_flags=self.ch_active_flags,
                     index=i,
+                    native_driver=self.native_driver,
                     desc=f"Channel {i}")
                 for i in range(self.n_channels)
                 ]
@@ -195,17 +284,40 @@ class HardwareInterface():
             callback()
 
     def _get_channel_active(self, index):
-        if hw_online_mode:
+        if self.hw_online_mode:
             self.ch[index].pull_hw_props()
         self._run_cbX_config()
     def _set_channel_active(self, index, activation=True):
         self.ch_active_flags[index] = activation
-        if hw_online_mode:
+        if self.hw_online_mode:
             self.ch[index].push_hw_props()
         self._run_cbX_config()
 
-    def _pull_data(self, len_min=1200):
+    def arm(self):
+        """Arm the trigger for a single acquisition"""
+        # This is an ivi driver call:
+        self.scope.measurement.initiate()
+
+    def wait_complete(self, timeout=10.0, poll_interval=0.01):
+        """Wait until the armed acquisition is complete.
+        Returns False if this takes longer than timeout seconds."""
+        deadline = time.monotonic() + timeout
+        # This is an ivi driver call:
+        while self.scope.measurement.status != "complete":
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def _pull_data(self, len_min=None, run_callbacks=True):
+        """Download samples of all channels. Returns True if all channels
+        delivered data. Data callbacks are only run in this case.
+
+        len_min: Number of samples to be read, default: self.mdepth
+        """
         print("pull data!")
+        if len_min is None:
+            len_min = self.mdepth
         # This is the current acquisition mode "run" is True, "stop" is False
         acquisition_running = self.scope.trigger.continuous
         # Only 1200 points can be read while in active RUN state, as far as
@@ -215,74 +327,336 @@ class HardwareInterface():
         if acquisition_running and len_min > 1200:
             self.scope.trigger.continuous = False
         # Updates self.sample_rate and Qt buton if necessary
-        self._get_sample_rate()
+        self._get_sample_rate(run_callbacks)
         # Updates self.n_samples and Qt button if necessary
-        self._get_mdepth()
-        for i in range(self.n_channels):
-            self.ch[i].pull_samples()
+        self._get_mdepth(run_callbacks)
+        self._get_start_time()
+        data_read = all([self.ch[i].pull_samples(self.mdepth)
+                         for i in range(self.n_channels)])
         if acquisition_running:
             self.scope.trigger.continuous = True
-        self._run_cbX_data()
+        # Multi-instrument acquisition pulls in worker threads and runs
+        # callbacks once for all instruments from the calling thread
+        if run_callbacks and data_read:
+            self._run_cbX_data()
+        return data_read
+
+    def time_bases(self):
+        """Returns a list of (sample rate, time of first sample relative to
+        the trigger) tuples by channel index. The time of first sample
+        includes the residual skew of each channel, which is applied as a
+        fractional delay by DataModel.get_window()."""
+        return [(self.sample_rate, self.start_time - ch.residual_skew)
+                for ch in self.ch]
+
+    def raw_frames(self):
+        """Returns a list of (raw codes, (gain, offset)) tuples of the last
+        native download, by channel index. Raw codes are None if not
+        available."""
+        return [(ch.raw, ch.raw_scaling) for ch in self.ch]
+
+    def save_capture(self, path, **kwargs):
+        """Save raw codes of the active channels of the last native download
+        into a compressed capture archive, see capture_archive.py.
+        kwargs are passed to capture_archive.write_capture()
+        """
+        chs = [ch for ch in self.ch
+               if self.ch_active_flags[ch.index] and ch.raw is not None]
+        time_bases = self.time_bases()
+        capture_archive.write_capture(
+                path,
+                [ch.raw for ch in chs],
+                gains=[ch.raw_scaling[0] for ch in chs],
+                offsets=[ch.raw_scaling[1] for ch in chs],
+                sample_rates=[time_bases[ch.index][0] for ch in chs],
+                t0s=[time_bases[ch.index][1] for ch in chs],
+                names=[f"CH{ch.index+1}" for ch in chs],
+                **kwargs)
 
     def _set_mdepth(self, value=None):
         """Send memory depth requested value to the connected device.
         Does NOT update self.n_samples """
         if value is not None:
             self.mdepth = int(value)
-        if hw_online_mode:
+        if self.hw_online_mode:
             print(f"Requesting memory depth (number of samples): {self.mdepth}")
             # This is a driver call
             self.scope.acquisition.number_of_points_minimum = self.mdepth
         self._run_cbX_config()
-    def _get_mdepth(self):
+    def _get_mdepth(self, run_callbacks=True):
         """Get memory depth value from scope, update property and call callbacks
         """
         # This is an ivi driver call:
-        if hw_online_mode:
+        if self.hw_online_mode:
             self.mdepth = self.scope.acquisition.record_length
         print(f"Number of samples is: {self.mdepth}")
-        self._run_cbX_config()
+        if run_callbacks:
+            self._run_cbX_config()
 
-    def _get_sample_rate(self):
+    def _get_start_time(self):
+        """Get time of the first sample relative to the trigger from scope"""
+        if self.hw_online_mode:
+            # This is an ivi driver call:
+            self.start_time = self.scope.acquisition.start_time
+
+    def _get_sample_rate(self, run_callbacks=True):
         """Get sample rate value from scope, update self.sample_rate and Qt
         widget if necessary"""
-        if hw_online_mode:
+        if self.hw_online_mode:
             # This is an ivi driver call:
             self.sample_rate = self.scope.acquisition.sample_rate
         print(f"Sample rate is: {self.sample_rate}")
-        self._run_cbX_config()
+        if run_callbacks:
+            self._run_cbX_config()
 
 
 class DataModel():
     """Measurement data model, data-dependent filter and DSP methods"""
     # List of callbacks to update GUI and possible outputs on updated data
     cbX_data = []
+    # List of callbacks run once per new acquisition frame only, not when
+    # e.g. filter settings change. Used for publishing frames.
+    cbX_frame = []
     def __init__(self, config):
         # Analog channel buffer for data access
         # Initialize with maximum memory configuration to be safe.
         # In case this fails due to low memory, this fails early.
-        # self.ch_buffers = np.zeros(
-        #         (config.n_channels, config.mdepth_max),
-        #         dtype = config.float_precision,
-        #         )
-        self.ch_buffers = [np.zeros(config.mdepth_max)] * config.n_channels
+        # List of row views, channels must not share the same buffer.
+        self.ch_buffers = list(np.zeros(
+                (config.n_channels, config.mdepth_max),
+                dtype=config.float_precision,
+                ))
+        # Per-channel sample rate and time of first sample relative to the
+        # trigger. These differ when merging data from several instruments.
+        self.ch_sample_rate = np.full(config.n_channels,
+                                      float(config.sample_rate_default))
+        self.ch_t0 = np.zeros(config.n_channels)
         # Filter kernel length
         self.filter_length = config.filter_length
         self.filter_chain = config.filter_chain
+        # Deskew and zoom interpolation, applied to the visible window only
+        self.interpolator = interpolation.SincInterpolator(
+                config.interp_half_length, dtype=config.float_precision)
+        self.upsample_max = config.upsample_max
+        # Persistence display accumulators, by channel index
+        self.density = {}
+        self.density_shape = config.density_shape
+        self.density_decay = config.density_decay
+        # Incremented for each new frame, part of all derived data cache keys
+        self.acq_id = 0
+        self.derived_cache = derived_cache.DerivedDataCache(
+                config.derived_cache_bytes)
+        # Filter results by channel index, None if not filtered
+        self.ch_filtered = [None] * config.n_channels
+        # Raw ADC codes and their (gain, offset) scaling, if available
+        self.ch_raw = [None] * config.n_channels
+        self.ch_raw_scaling = [(1.0, 0.0)] * config.n_channels
+        # Math channels by name. Wherever a channel index is accepted, a math
+        # channel name can be used as well.
+        self.math_channels = {}
+        for name, expression in config.math_channels.items():
+            self.add_math_channel(name, expression)
+
+    def add_math_channel(self, name, expression):
+        math_channel = math_channels.MathChannel(expression, self.ch_buffers)
+        assert self._is_aligned(math_channel), (
+                f"Sources of math channel {name} have different time bases")
+        self.math_channels[name] = math_channel
+
+    def _is_aligned(self, math_channel):
+        """Math channels combine samples by index. This is only valid if
+        all sources have the same sample rate and time of first sample."""
+        sources = list(math_channel.sources.values())
+        sample_rates = self.ch_sample_rate[sources]
+        t0s = self.ch_t0[sources]
+        return (np.all(sample_rates == sample_rates[0])
+                and np.all(t0s == t0s[0]))
+
+    def _math_channel(self, ch):
+        math_channel = self.math_channels[ch]
+        # Time bases change with each merged multi-instrument frame
+        assert self._is_aligned(math_channel), (
+                f"Sources of math channel {ch} have different time bases")
+        return math_channel
+
+    def remove_math_channel(self, name):
+        self.math_channels.pop(name, None)
+
+    def _source_channel(self, ch):
+        """Analog channel index defining time base and filter of channel ch"""
+        if ch in self.math_channels:
+            return self.math_channels[ch].first_source
+        return ch
+
+    def time_base(self, ch):
+        """Returns (sample rate, time of first sample) of channel ch"""
+        source = self._source_channel(ch)
+        return self.ch_sample_rate[source], self.ch_t0[source]
+
+    def get_channel(self, ch):
+        """Sample vector of analog channel index ch, or the MathChannel
+        named ch. Both support len() and slicing.
+        """
+        if ch in self.math_channels:
+            return self._math_channel(ch)
+        return self.ch_buffers[ch]
+
+    def get_samples(self, ch, start=0, stop=None, step=1):
+        """Returns samples start, start+step... up to stop-1 of channel ch.
+
+        Analog channels return views. Math channels are evaluated for the
+        requested samples only.
+        """
+        if ch in self.math_channels:
+            return self._math_channel(ch).evaluate(start, stop, step)
+        return self.ch_buffers[ch][start:stop:step]
+
+    def get_full(self, ch):
+        """Complete record of channel ch. Math channels are evaluated once
+        per frame and cached.
+        """
+        if ch not in self.math_channels:
+            return self.ch_buffers[ch]
+        math_channel = self._math_channel(ch)
+        key = (self.acq_id, ch, "samples", math_channel.expression)
+        return self.derived_cache.get_or_compute(key, math_channel.evaluate)
+
+    def get_filtered(self, ch):
+        """Returns channel ch filtered by self.filter_chain with the
+        current filter_length. Results are cached until the next frame.
+
+        filter_chain is either one filter function for all channels or a
+        sequence of per-channel filter functions. Math channels use the filter
+        of their first source channel.
+        """
+        if callable(self.filter_chain):
+            filter_func = self.filter_chain
+        else:
+            filter_func = self.filter_chain[self._source_channel(ch)]
+        key = (self.acq_id, ch, filter_func, self.filter_length)
+        return self.derived_cache.get_or_compute(
+                key, lambda: filter_func(self.get_full(ch), self.filter_length))
 
     def apply_filters(self, channels):
         """Apply filters defined as self.filter_chain"""
         for i in channels:
-            self.filter_chain[i](self.ch_buffer[i], self.filter_length)
+            if i in self.math_channels:
+                # Cached, fetched with get_filtered()
+                self.get_filtered(i)
+            else:
+                self.ch_filtered[i] = self.get_filtered(i)
         self.exec_cbX()
     
+    def get_window(self, ch, t_start, t_stop, n_points):
+        """Returns time and sample vectors of channel ch for the time
+        span t_start...t_stop, aligned to the common trigger time base.
+
+        If there are fewer samples than n_points (display pixels) in the time
+        span, samples are fractionally deskewed and band-limited (sin(x)/x)
+        interpolated. Otherwise, the raw samples nearest to the time grid are
+        returned, as sub-sample deskew is then not visible.
+
+        Math channels are only evaluated within the time span.
+        """
+        sample_rate, t0 = self.time_base(ch)
+        n_samples = len(self.get_channel(ch))
+        pos = (t_start - t0) * sample_rate
+        start = int(np.floor(pos))
+        n_in = max(int(np.ceil((t_stop - t_start) * sample_rate)), 1)
+        if n_in >= n_points:
+            start = int(np.clip(round(pos), 0, n_samples))
+            samples = self.get_samples(ch, start, start + n_in)
+            time = t0 + (start + np.arange(samples.size)) / sample_rate
+            return time, samples
+        upsample = min(-(-n_points // n_in), self.upsample_max)
+        # Only the window plus the interpolation kernel support is needed
+        margin = self.interpolator.half_length + 2
+        seg_start = int(np.clip(start - margin, 0, n_samples - 1))
+        seg_stop = max(start + n_in + margin, seg_start + 1)
+        segment = self.get_samples(ch, seg_start, seg_stop)
+        samples = self.interpolator.interpolate(
+                segment, start - seg_start, start + n_in - seg_start,
+                upsample, delay=start - pos)
+        time = t_start + np.arange(samples.size) / (upsample * sample_rate)
+        return time, samples
+
+    def enable_density(self, ch, y_range, enable=True):
+        """Start or stop accumulating the persistence display of channel
+        index ch for amplitudes within y_range = (y_min, y_max)
+        """
+        if enable:
+            n_time, n_amp = self.density_shape
+            self.density[ch] = persistence.DensityAccumulator(
+                    n_time, n_amp, y_range, self.density_decay)
+        else:
+            self.density.pop(ch, None)
+
+    def get_edges(self, ch, low, high):
+        """Returns protocol_decode.Edges of channel ch, thresholded with
+        hysteresis between low and high in physical units.
+
+        Raw codes are thresholded directly if available. Results are cached
+        until the next frame.
+        """
+        def compute():
+            raw = None if ch in self.math_channels else self.ch_raw[ch]
+            if raw is None:
+                return protocol_decode.find_edges(self.get_full(ch), low, high)
+            gain, offset = self.ch_raw_scaling[ch]
+            code_low, code_high = sorted(
+                    ((low - offset) / gain, (high - offset) / gain))
+            # Integer thresholds, integer comparisons
+            info = np.iinfo(raw.dtype)
+            code_low = int(np.clip(np.floor(code_low), info.min, info.max))
+            code_high = int(np.clip(np.ceil(code_high), info.min, info.max))
+            edges = protocol_decode.find_edges(raw, code_low, code_high)
+            if gain < 0:
+                # Higher codes are lower voltages
+                edges = edges._replace(initial_level=1-edges.initial_level)
+            return edges
+        key = (self.acq_id, ch, "edges", low, high)
+        return self.derived_cache.get_or_compute(key, compute)
+
+    def on_new_frame(self, raw_frames=None, time_bases=None):
+        """Update derived data when the hardware interface acquired a new
+        frame into ch_buffers, then run data callbacks
+
+        raw_frames: Optional list of (raw codes, (gain, offset)) by channel
+        time_bases: Optional list of (sample rate, time of first sample) by
+                    channel, see HardwareInterface.time_bases()
+        """
+        # Derived data of the previous frame is stale
+        self.derived_cache.invalidate()
+        self.acq_id += 1
+        self.ch_filtered = [None] * len(self.ch_buffers)
+        if raw_frames is not None:
+            self.ch_raw = [i[0] for i in raw_frames]
+            self.ch_raw_scaling = [i[1] for i in raw_frames]
+        if time_bases is not None:
+            for ch, (sample_rate, t0) in enumerate(time_bases):
+                self.ch_sample_rate[ch] = sample_rate
+                self.ch_t0[ch] = t0
+        for ch, accumulator in self.density.items():
+            if (ch in self.math_channels
+                    and not self._is_aligned(self.math_channels[ch])):
+                continue
+            # Chunked, math channels are not evaluated as a whole
+            accumulator.add_frame(self.get_channel(ch))
+        for callback in self.cbX_frame:
+            callback()
+        self.exec_cbX()
+
     def register_cb_data(self, callback):
         if callback not in self.cbX_data:
             self.cbX_data.append(callback)
 
+    def register_cb_frame(self, callback):
+        if callback not in self.cbX_frame:
+            self.cbX_frame.append(callback)
+
     def exec_cbX(self):
-        for i in self.cbX_data:
-            self.cbX_data()
+        for callback in self.cbX_data:
+            callback()
 
     def poll_loop(self):
         pass
@@ -292,13 +666,22 @@ class DataModel():
 class QtUi(QMainWindow):
     def __init__(self, config, model, hw_if):
         super().__init__()
+        self.model = model
+        self.hw_if = hw_if
         # Loads Qt Designer .ui file and creates an instance of the user
         # interface in this QMainWindow instance. This automatically adds
         # any further widgets defined in the .ui file to this main instance.
         # (e.g. MplWidget)
         PyQt5.uic.loadUi("hdscope.ui", baseinstance=self)
         self.setWindowTitle("PyQt5 & Matplotlib HD Oscilloscope")
-        self.addToolBar(MplToolbar(self.MplWidget.canvas_qt, self))
+        # The .ui file has a MplWidget placeholder, replaced if configured
+        if type(self.MplWidget) is not config.plot_widget_class:
+            plot_widget = config.plot_widget_class(self)
+            self.MplWidget.parentWidget().layout().replaceWidget(
+                    self.MplWidget, plot_widget)
+            self.MplWidget.deleteLater()
+            self.MplWidget = plot_widget
+        self.addToolBar(self.MplWidget.make_toolbar(self))
 
         for text, value in zip(config.mdepth_text, config.mdepth_values):
             self.inputbox_mdepth.addItem(text, value)
@@ -323,9 +706,38 @@ class QtUi(QMainWindow):
         self.checkbox_V2.stateChanged.connect(self.MplWidget.cursors[3].set_enabled)
         self.MplWidget.cursors[3].callback = self.checkbox_V2.setChecked
 
+    def apply_filter(self):
+        channels = [i for i, active in enumerate(self.hw_if.ch_active_flags)
+                    if active]
+        self.model.apply_filters(channels)
+        stats = self.model.derived_cache.stats()
+        self.statusbar.showMessage(
+                f"Filter cache hit rate: {stats['hit_rate']:.0%}, "
+                f"{stats['entries']} entries, {stats['bytes']/2**20:.0f} MiB")
+
+    def show_annotations(self, annotations, ch, y):
+        """Overlay protocol_decode.Annotations decoded from channel ch
+        at vertical position y"""
+        sample_rate, t0 = self.model.time_base(ch)
+        self.MplWidget.plot_annotations(
+                t0 + annotations.start / sample_rate,
+                t0 + annotations.stop / sample_rate,
+                annotations.text, y)
+
+    def update_density_plot(self, ch):
+        accumulator = self.model.density[ch]
+        sample_rate, t0 = self.model.time_base(ch)
+        time_span = len(self.model.get_channel(ch)) / sample_rate
+        self.MplWidget.plot_density(
+                accumulator.image(), (t0, t0 + time_span, *accumulator.y_range))
+
     def update_plot(self):
-        self.MplWidget.plot_new(self.sample_rate, self.n_samples,
-                self.channels_active, self.ydata)
+        # Per-channel time bases align traces of merged instruments
+        model = self.model
+        self.MplWidget.plot_new(
+                model.ch_buffers[0].size / model.ch_sample_rate[0],
+                self.hw_if.ch_active_flags, model.ch_buffers,
+                [model.time_base(i) for i in range(len(model.ch_buffers))])
 
 
 class WorkerThread(QThread):
@@ -347,11 +759,32 @@ model = DataModel(Config)
 hw_if = HardwareInterface(Config, model.ch_buffers)
 if QApplication.instance() is None: app = QApplication(sys.argv) 
 qt_gui = QtUi(Config, model, hw_if)
+hw_if.register_cb_data(lambda: model.on_new_frame(
+        hw_if.raw_frames(), hw_if.time_bases()))
 
 # FIXME: poll thread etc
 
 qt_gui.show()
 atexit.register(hw_if.scope.close)
+
+# Zero-copy access for external analysis processes
+if Config.shm_name is not None:
+    shm_pub = shm_publish.FramePublisher(
+            Config.shm_name, Config.n_channels, Config.mdepth_max,
+            dtype=Config.float_precision)
+    model.register_cb_frame(lambda: shm_pub.publish(
+            model.ch_buffers, model.ch_sample_rate, model.ch_t0))
+    atexit.register(shm_pub.close)
+
+# Pass/fail mask testing of each acquisition, on raw codes
+if Config.mask_files:
+    mask_stage = mask_test.MaskTestStage(
+            hw_if,
+            {ch: mask_test.MaskTest.from_file(path)
+                for ch, path in Config.mask_files.items()},
+            Config.mask_save_dir)
+    hw_if.register_cb_data(mask_stage)
+    atexit.register(mask_stage.close)
 ################################################################
 
 # Shortcuts for interactive use
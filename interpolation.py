@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Band-limited sin(x)/x interpolation and fractional delay
+
+Only the requested window of a record is processed, so zooming into a deep
+memory acquisition or deskewing channels by fractions of a sample never
+upsamples the whole record.
+"""
+import numpy as np
+from collections import OrderedDict
+
+
+def kaiser_sinc(x, half_length, beta=8.0):
+    """Kaiser-windowed sin(x)/x evaluated at arbitrary (non-integer) positions
+    x in units of samples. Zero outside of |x| < half_length.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    ratio = np.clip(x / half_length, -1.0, 1.0)
+    window = np.i0(beta * np.sqrt(1.0 - ratio**2)) / np.i0(beta)
+    return np.where(np.abs(x) < half_length, np.sinc(x) * window, 0.0)
+
+
+class SincInterpolator():
+    """Polyphase windowed-sinc interpolator with fractional delay.
+
+    Init args:
+    half_length:        Kernel half length in input samples. Each output sample
+                        is computed from 2*half_length input samples.
+    delay_resolution:   Fractional delays are quantized to this fraction of a
+                        sample, so that kernel banks can be cached per delay
+    max_cached:         Maximum number of cached kernel banks (LRU)
+    dtype:              Floating point type of the taps and of the output
+
+    Kernel banks are cached per (quantized fractional delay, upsampling
+    factor). Integer parts of a delay are applied as an index shift only.
+    """
+    def __init__(self, half_length=16, delay_resolution=1/1024, max_cached=64,
+                 dtype=np.float64):
+        self.half_length = half_length
+        self.dtype = dtype
+        self.n_steps = int(round(1 / delay_resolution))
+        self.max_cached = max_cached
+        self._cache = OrderedDict()
+
+    def kernels(self, delay, upsample=1):
+        """Returns a tuple (offsets, taps) for a signal delay in input samples
+        and an integer upsampling factor.
+
+        Output sample p (0...upsample-1) of each input sample period k is:
+        y[k*upsample + p] = sum(x[k + offsets[p] + j] * taps[p, j+half_length-1]
+                                for j in range(-half_length+1, half_length+1))
+        """
+        n_int, step = divmod(int(round(delay * self.n_steps)), self.n_steps)
+        key = (step, upsample)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            offsets, taps = self._cache[key]
+        else:
+            offsets, taps = self._make_kernels(step / self.n_steps, upsample)
+            self._cache[key] = (offsets, taps)
+            if len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        return offsets - n_int, taps
+
+    def _make_kernels(self, delay_frac, upsample):
+        m = self.half_length
+        # Output positions in input sample units, relative to sample k
+        phase = np.arange(upsample) / upsample - delay_frac
+        offsets = np.floor(phase).astype(np.intp)
+        frac = phase - offsets
+        j = np.arange(-m + 1, m + 1)
+        taps = kaiser_sinc(j[np.newaxis, :] - frac[:, np.newaxis], m)
+        # Unity DC gain for each phase
+        taps /= taps.sum(axis=1, keepdims=True)
+        return offsets, taps.astype(self.dtype)
+
+    def interpolate(self, x, start, stop, upsample=1, delay=0.0):
+        """Returns (stop-start)*upsample samples of x, delayed by delay input
+        samples and upsampled by an integer factor, for the input index range
+        start...stop-1.
+
+        Input samples outside of the record are replaced by the edge values.
+        """
+        m = self.half_length
+        n = stop - start
+        offsets, taps = self.kernels(delay, upsample)
+        lo = start + offsets.min() - m + 1
+        hi = stop + offsets.max() + m
+        # Window-sized copy only, clipped indices repeat the edge samples
+        segment = x[np.clip(np.arange(lo, hi), 0, x.size - 1)]
+        out = np.empty(n * upsample, dtype=taps.dtype)
+        for p in range(upsample):
+            base = start + offsets[p] - m + 1 - lo
+            out[p::upsample] = np.correlate(
+                    segment[base:base + n + 2*m - 1], taps[p], mode="valid")
+        return out
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Mask / limit testing for continuous acquisition
+
+Frames are compared against lower and upper limit envelopes in raw ADC
+codes, i.e. without converting samples to float. Comparison runs in
+cache-sized chunks with pre-allocated boolean buffers, so checking a frame
+costs about as much as reading it once from memory.
+"""
+import os
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import capture_archive
+
+
+class MaskTest():
+    """Pass/fail test of raw sample frames against limit envelopes.
+
+    Init args:
+    lower, upper:   Limit envelopes in raw codes, same dtype as the frames.
+                    Samples are valid if lower <= sample <= upper.
+    scaling:        Tuple (gain, offset) of the raw codes of the envelopes,
+                    physical = raw*gain + offset. None if unknown.
+    n_bins:         Number of bins of the violation location histogram
+    chunk_size:     Number of samples compared at a time
+
+    Public members:
+    n_frames, n_failed:     Number of frames tested and failed
+    n_violations:           Total number of samples outside the limits
+    violation_hist:         Histogram of violation locations over the record
+    """
+    def __init__(self, lower, upper, scaling=None, n_bins=1000,
+                 chunk_size=2**18):
+        assert lower.shape == upper.shape, "Envelopes must have the same size"
+        assert lower.dtype == upper.dtype, "Envelopes must have the same dtype"
+        self.lower = lower
+        self.upper = upper
+        self.scaling = None if scaling is None else tuple(scaling)
+        self.n_bins = n_bins
+        self.chunk_size = chunk_size
+        self._below = np.empty(chunk_size, dtype=bool)
+        self._above = np.empty(chunk_size, dtype=bool)
+        self.reset_stats()
+
+    @classmethod
+    def from_golden(cls, golden, tolerance, time_tolerance=0, **kwargs):
+        """Derive envelopes from a golden capture in raw codes. Pass the
+        (gain, offset) scaling of the golden capture as scaling keyword.
+
+        tolerance:      Allowed deviation in codes
+        time_tolerance: Allowed horizontal deviation in samples. The envelopes
+                        are widened by the min/max of the neighbourhood.
+        """
+        info = np.iinfo(golden.dtype)
+        wide = golden.astype(np.int32)
+        lower = wide.copy()
+        upper = wide.copy()
+        for shift in range(1, time_tolerance + 1):
+            np.minimum(lower[shift:], wide[:-shift], out=lower[shift:])
+            np.minimum(lower[:-shift], wide[shift:], out=lower[:-shift])
+            np.maximum(upper[shift:], wide[:-shift], out=upper[shift:])
+            np.maximum(upper[:-shift], wide[shift:], out=upper[:-shift])
+        lower -= tolerance
+        upper += tolerance
+        lower = np.clip(lower, info.min, info.max).astype(golden.dtype)
+        upper = np.clip(upper, info.min, info.max).astype(golden.dtype)
+        return cls(lower, upper, **kwargs)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Load envelopes and their scaling saved by save()"""
+        with np.load(path) as data:
+            if "scaling" in data:
+                kwargs.setdefault("scaling", data["scaling"].tolist())
+            return cls(data["lower"], data["upper"], **kwargs)
+
+    def save(self, path):
+        if self.scaling is None:
+            np.savez(path, lower=self.lower, upper=self.upper)
+        else:
+            np.savez(path, lower=self.lower, upper=self.upper,
+                     scaling=np.array(self.scaling))
+
+    def rescale(self, scaling):
+        """Convert the envelopes to raw codes of a new (gain, offset)
+        scaling, e.g. after the V/div or offset setting changed. Limits are
+        rounded outwards.
+        """
+        gain, offset = self.scaling
+        new_gain, new_offset = scaling
+        info = np.iinfo(self.lower.dtype)
+        limits = []
+        for envelope in (self.lower, self.upper):
+            codes = (envelope * gain + offset - new_offset) / new_gain
+            limits.append(codes)
+        if new_gain * gain < 0:
+            # Inverted: higher codes are lower voltages now
+            limits.reverse()
+        lower, upper = limits
+        self.lower = np.clip(np.floor(lower), info.min, info.max).astype(
+                self.lower.dtype)
+        self.upper = np.clip(np.ceil(upper), info.min, info.max).astype(
+                self.upper.dtype)
+        self.scaling = tuple(scaling)
+
+    def reset_stats(self):
+        self.n_frames = 0
+        self.n_failed = 0
+        self.n_violations = 0
+        self.violation_hist = np.zeros(self.n_bins, dtype=np.int64)
+
+    def check(self, raw):
+        """Test one frame of raw codes and update statistics.
+
+        Only the leading part common to the frame and the envelopes is
+        tested. Returns the number of violating samples, 0 meaning pass.
+        """
+        n = min(raw.size, self.lower.size)
+        n_violations = 0
+        for start in range(0, n, self.chunk_size):
+            stop = min(start + self.chunk_size, n)
+            below = self._below[:stop-start]
+            above = self._above[:stop-start]
+            np.less(raw[start:stop], self.lower[start:stop], out=below)
+            np.greater(raw[start:stop], self.upper[start:stop], out=above)
+            np.logical_or(below, above, out=below)
+            n_chunk = int(np.count_nonzero(below))
+            if n_chunk:
+                # Rare case, cost does not matter
+                positions = np.flatnonzero(below) + start
+                self.violation_hist += np.bincount(
+                        positions * self.n_bins // n, minlength=self.n_bins)
+                n_violations += n_chunk
+        self.n_frames += 1
+        if n_violations:
+            self.n_failed += 1
+            self.n_violations += n_violations
+        return n_violations
+
+    def summary(self):
+        return {
+                "frames": self.n_frames,
+                "failed": self.n_failed,
+                "passed": self.n_frames - self.n_failed,
+                "violations": self.n_violations,
+                }
+
+
+class MaskTestStage():
+    """Runs mask tests on each new frame of a HardwareInterface.
+
+    Init args:
+    hw_if:      HardwareInterface with a native driver providing raw codes
+    mask_tests: Dict of MaskTest instances by channel index
+    save_dir:   If not None, failing frames of the failing channels are saved
+                here as compressed capture archives, in a background thread
+    max_pending_saves:
+                Maximum number of frames queued for saving. Further failing
+                frames are not saved while the queue is full, so memory stays
+                bounded if frames fail faster than they can be written.
+
+    Public members:
+    n_save_dropped: Number of failing channel frames not saved
+
+    Register an instance as a data callback of the hardware interface.
+    """
+    def __init__(self, hw_if, mask_tests, save_dir=None, max_pending_saves=4):
+        assert hw_if.native_driver is not None, (
+                "Mask testing needs raw codes from a native driver")
+        self.hw_if = hw_if
+        self.mask_tests = mask_tests
+        self.save_dir = save_dir
+        self.n_frames = 0
+        self.max_pending_saves = max_pending_saves
+        self.n_save_dropped = 0
+        self._n_pending = 0
+        self._pending_lock = threading.Lock()
+        # One writer thread keeps saving from blocking the acquisition
+        self._writer = ThreadPoolExecutor(max_workers=1)
+
+    def __call__(self):
+        self.n_frames += 1
+        for ch, mask_test in self.mask_tests.items():
+            raw = self.hw_if.ch[ch].raw
+            if raw is None:
+                continue
+            scaling = tuple(self.hw_if.ch[ch].raw_scaling)
+            if mask_test.scaling is None:
+                # Envelopes without scaling refer to the first tested frame
+                mask_test.scaling = scaling
+            elif scaling != mask_test.scaling:
+                # V/div or offset changed, limits must keep their voltages
+                print(f"Channel {ch+1} scaling changed, rescaling mask")
+                mask_test.rescale(scaling)
+            if mask_test.check(raw) and self.save_dir is not None:
+                self._save(ch, raw)
+
+    def _save(self, ch, raw):
+        with self._pending_lock:
+            if self._n_pending >= self.max_pending_saves:
+                self.n_save_dropped += 1
+                return
+            self._n_pending += 1
+        path = os.path.join(self.save_dir,
+                            f"fail_{self.n_frames:08d}_ch{ch+1}.hdcap")
+        gain, offset = self.hw_if.ch[ch].raw_scaling
+        sample_rate, t0 = self.hw_if.time_bases()[ch]
+        # The raw buffer is re-used for the next frame
+        future = self._writer.submit(
+                capture_archive.write_capture, path, [raw.copy()],
+                gains=[gain], offsets=[offset], sample_rates=[sample_rate],
+                t0s=[t0], names=[f"CH{ch+1}"])
+        future.add_done_callback(self._save_done)
+
+    def _save_done(self, future):
+        with self._pending_lock:
+            self._n_pending -= 1
+
+    def summary(self):
+        return {ch: i.summary() for ch, i in self.mask_tests.items()}
+
+    def close(self):
+        self._writer.shutdown(wait=True)
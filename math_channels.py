@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Lazily evaluated math channels
+
+A math channel is an arithmetic expression over the analog channels, e.g.
+"CH1*CH2" for instantaneous power or "(CH1-CH2)*0.1" for a scaled
+differential current probe. Nothing is computed when the channel is
+defined. Evaluation only covers the requested region and resolution and runs
+in cache-sized chunks, so no full-length temporaries are allocated.
+"""
+import ast
+import numpy as np
+
+_BINARY_OPS = {
+        ast.Add: np.add,
+        ast.Sub: np.subtract,
+        ast.Mult: np.multiply,
+        ast.Div: np.true_divide,
+        ast.Pow: np.power,
+        }
+_UNARY_OPS = {
+        ast.USub: np.negative,
+        ast.UAdd: np.positive,
+        }
+_FUNCTIONS = {
+        "abs": np.abs,
+        "sqrt": np.sqrt,
+        "exp": np.exp,
+        "log": np.log,
+        "log10": np.log10,
+        "sin": np.sin,
+        "cos": np.cos,
+        "minimum": np.minimum,
+        "maximum": np.maximum,
+        }
+
+
+class MathChannel():
+    """Channel defined by an expression over analog channels CH1...CHn.
+
+    Init args:
+    expression: Arithmetic expression using channel names CH1, CH2... (the
+                one-based GUI channel numbers), numbers, + - * / ** and the
+                functions in _FUNCTIONS
+    ch_buffers: List of channel sample vectors, by reference. Always the
+                current frame is evaluated.
+    chunk_size: Number of samples evaluated at a time
+
+    Sources are combined sample by sample. They must share one time base,
+    which DataModel checks.
+
+    Supports len() and slicing, so it can be used in place of a sample
+    vector. np.asarray() evaluates the complete record.
+    """
+    def __init__(self, expression, ch_buffers, chunk_size=2**16):
+        self.expression = expression
+        self.ch_buffers = ch_buffers
+        self.chunk_size = chunk_size
+        self._tree = ast.parse(expression, mode="eval")
+        # Channel names used in the expression, mapped to channel indices
+        self.sources = {}
+        self._check(self._tree.body)
+        assert self.sources, "Expression must use at least one channel"
+
+    def _check(self, node):
+        """Allow only arithmetic and collect referenced channel names"""
+        if isinstance(node, ast.BinOp):
+            assert type(node.op) in _BINARY_OPS, "Unsupported operator"
+            self._check(node.left)
+            self._check(node.right)
+        elif isinstance(node, ast.UnaryOp):
+            assert type(node.op) in _UNARY_OPS, "Unsupported operator"
+            self._check(node.operand)
+        elif isinstance(node, ast.Call):
+            assert (isinstance(node.func, ast.Name)
+                    and node.func.id in _FUNCTIONS), "Unsupported function"
+            assert not node.keywords, "Keyword arguments not supported"
+            for arg in node.args:
+                self._check(arg)
+        elif isinstance(node, ast.Name):
+            name = node.id.upper()
+            assert name.startswith("CH") and name[2:].isdigit(), (
+                    f"Unknown name: {node.id}")
+            index = int(name[2:]) - 1
+            assert 0 <= index < len(self.ch_buffers), (
+                    f"No such channel: {node.id}")
+            self.sources[node.id] = index
+        else:
+            assert (isinstance(node, ast.Constant)
+                    and isinstance(node.value, (int, float))), (
+                    "Unsupported expression")
+
+    def _eval(self, node, inputs):
+        if isinstance(node, ast.BinOp):
+            return _BINARY_OPS[type(node.op)](
+                    self._eval(node.left, inputs), self._eval(node.right, inputs))
+        if isinstance(node, ast.UnaryOp):
+            return _UNARY_OPS[type(node.op)](self._eval(node.operand, inputs))
+        if isinstance(node, ast.Call):
+            return _FUNCTIONS[node.func.id](
+                    *(self._eval(arg, inputs) for arg in node.args))
+        if isinstance(node, ast.Name):
+            return inputs[node.id]
+        return node.value
+
+    @property
+    def first_source(self):
+        """Channel index defining time base and scaling of the result"""
+        return min(self.sources.values())
+
+    def __len__(self):
+        return min(self.ch_buffers[i].size for i in self.sources.values())
+
+    @property
+    def size(self):
+        return len(self)
+
+    @property
+    def dtype(self):
+        """Float32 sources give float32 results"""
+        return np.result_type(
+                *(self.ch_buffers[i].dtype for i in self.sources.values()))
+
+    def _chunk(self, a, b, step):
+        # Views of the inputs, no copies
+        inputs = {name: self.ch_buffers[i][a:b:step]
+                  for name, i in self.sources.items()}
+        return self._eval(self._tree.body, inputs)
+
+    def evaluate(self, start=0, stop=None, step=1, out=None):
+        """Returns samples start, start+step... up to stop-1.
+
+        Evaluating with step > 1 computes the subsampled points only.
+        """
+        start, stop, step = slice(start, stop, step).indices(len(self))
+        n_out = len(range(start, stop, step))
+        if out is None:
+            out = np.empty(n_out, dtype=self.dtype)
+        for k in range(0, n_out, self.chunk_size):
+            k_stop = min(k + self.chunk_size, n_out)
+            out[k:k_stop] = self._chunk(start + k*step, start + k_stop*step,
+                                        step)
+        return out[:n_out]
+
+    def evaluate_minmax(self, start, stop, n_buckets):
+        """Evaluate the full resolution region start...stop-1, but return only
+        minimum and maximum of each of about n_buckets intervals, see
+        filters.downsample_minmax().
+
+        Returns the min/max vector and the number of samples per interval.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        factor = max(-(-(stop - start) // n_buckets), 1)
+        n_out = (stop - start) // factor
+        out = np.empty((n_out, 2), dtype=self.dtype)
+        # Chunks contain whole intervals
+        chunk = max(self.chunk_size // factor, 1) * factor
+        for a in range(start, start + n_out*factor, chunk):
+            b = min(a + chunk, start + n_out*factor)
+            blocks = np.asarray(self._chunk(a, b, 1)).reshape(-1, factor)
+            i = (a - start) // factor
+            np.min(blocks, axis=1, out=out[i:i+blocks.shape[0], 0])
+            np.max(blocks, axis=1, out=out[i:i+blocks.shape[0], 1])
+        return out.reshape(-1), factor
+
+    def __getitem__(self, index):
+        assert isinstance(index, slice), "Only slices are supported"
+        return self.evaluate(index.start or 0, index.stop, index.step or 1)
+
+    def __array__(self, dtype=None, copy=None):
+        samples = self.evaluate()
+        return samples if dtype is None else samples.astype(dtype)
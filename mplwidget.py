@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 from pyqt_debug import debug_trace
 import numpy as np
-from PyQt5.QtWidgets import QWidget,QVBoxLayout
+from PyQt5.QtWidgets import QVBoxLayout
 import matplotlib.backends.backend_qt5agg as mpl_backend_qt
 import matplotlib.figure
+from matplotlib.collections import LineCollection
+from plotwidget import PlotWidgetBase
 
 class Cursor():
     handle = None # matplotlib.lines.Line2D object
@@ -64,8 +66,10 @@ class Cursor():
             self.handle.set_xdata(x)
 
 
-class MplWidget(QWidget):
+class MplWidget(PlotWidgetBase):
     cursor_selected = None
+    # Matplotlib text artists are slow, more annotations are not shown
+    n_annotations_max = 200
 
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -81,6 +85,11 @@ class MplWidget(QWidget):
         vertical_layout.addWidget(self.canvas_qt)
         self.setLayout(vertical_layout)
 
+        # Protocol annotations: start times, stop times, texts, y position
+        self.annotations = None
+        self.annotation_artists = []
+        self._connect_axes()
+
         # Setup callbacks
         self.canvas_qt.mpl_connect("motion_notify_event", self.onMouseMove)
         self.canvas_qt.mpl_connect("pick_event", self.itemPicked)
@@ -96,20 +105,84 @@ class MplWidget(QWidget):
                 ]
         self.canvas_qt.draw_idle()
 
-    def plot_new(self, time_span, channels, ydata):
+    def _connect_axes(self):
+        # Axes.clear() also drops the axes callbacks
+        self.subplot1.callbacks.connect(
+                "xlim_changed", lambda ax: self._draw_annotations())
+
+    def _on_clear(self):
+        """Restore callbacks and overlays after self.subplot1.clear()"""
+        self.annotation_artists = []
+        self._connect_axes()
+        self._draw_annotations()
+
+    def plot_new(self, time_span, channels, ydata, time_bases=None):
         self.subplot1.clear()
-        time = np.arange(0.0, time_span, time_span/len(ydata))
-        print(f"Len_time: {len(time)}")
-        print(f"Len_ydata: {len(ydata[0].x)}")
-        for y_i in ydata:
+        for i, y_i in enumerate(ydata):
             if len(y_i) > 1:
-                self.subplot1.plot(y_i)
+                if time_bases is None:
+                    t0, dt = 0.0, time_span / len(y_i)
+                else:
+                    sample_rate, t0 = time_bases[i]
+                    dt = 1.0 / sample_rate
+                time = t0 + np.arange(len(y_i)) * dt
+                self.subplot1.plot(time, y_i)
 #        self.subplot1.legend(('cosinus', 'sinus'),loc='upper right')
         self.subplot1.set_title('Scope Data')
+        self._on_clear()
         for i in self.cursors:
             i.restore()
         self.canvas_qt.draw_idle()
 
+    def plot_density(self, image, extent):
+        self.subplot1.clear()
+        # Zero counts are transparent
+        self.subplot1.imshow(
+                np.ma.masked_equal(image, 0), extent=extent, origin="lower",
+                aspect="auto", interpolation="nearest", cmap="inferno_r")
+        self.subplot1.set_title('Scope Data Persistence')
+        self._on_clear()
+        for i in self.cursors:
+            i.restore()
+        self.canvas_qt.draw_idle()
+
+    def plot_annotations(self, t_start, t_stop, text, y):
+        self.annotations = (t_start, t_stop, text, y) if len(t_start) else None
+        self._draw_annotations()
+
+    def _draw_annotations(self):
+        """Re-create the annotation artists for the current view. This runs
+        on every x axis limit change, e.g. toolbar zoom and pan."""
+        # This may apply pending autoscaling and re-enter via xlim_changed,
+        # so it comes before removing the previous artists
+        x0, x1 = self.subplot1.get_xlim()
+        for artist in self.annotation_artists:
+            if artist.axes is not None:
+                artist.remove()
+        self.annotation_artists = []
+        if self.annotations is not None:
+            t_start, t_stop, text, y = self.annotations
+            # Visible annotations only, including those starting left of
+            # the view and ending within it
+            a = np.searchsorted(t_stop, x0)
+            b = min(np.searchsorted(t_start, x1), a + self.n_annotations_max)
+            if b > a:
+                segments = np.stack(
+                        (np.column_stack((t_start[a:b], np.full(b-a, y))),
+                         np.column_stack((t_stop[a:b], np.full(b-a, y)))),
+                        axis=1)
+                # Not part of autoscaling, the limits must not change here
+                lines = LineCollection(segments, colors="k", linewidths=3)
+                self.subplot1.add_collection(lines, autolim=False)
+                self.annotation_artists.append(lines)
+            for x, s in zip(t_start[a:b], text[a:b]):
+                self.annotation_artists.append(self.subplot1.text(
+                        max(x, x0), y, s, fontsize=8, clip_on=True,
+                        verticalalignment="bottom"))
+        self.canvas_qt.draw_idle()
+
+    def make_toolbar(self, parent):
+        return mpl_backend_qt.NavigationToolbar2QT(self.canvas_qt, parent)
 
     def update_graph_simulation(self):
         fs = 500
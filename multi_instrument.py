@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent acquisition from several oscilloscopes
+
+Each instrument is served by its own HardwareInterface instance and worker
+thread. VISA network I/O releases the GIL, so the total capture time is that
+of the slowest instrument instead of the sum of all download times.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MultiInstrumentAcquisition():
+    """Arms and downloads from several instruments concurrently and merges
+    all channels into one DataModel frame.
+
+    Init args:
+    hw_ifs:     List of HardwareInterface instances, one per instrument
+    model:      DataModel instance, configured with the total number of
+                channels of all instruments
+    trigger_offsets:
+                Per-instrument time of its trigger event in seconds relative
+                to the trigger of the first (reference) instrument, e.g. from
+                cable delays or from a calibration capture. Positive if the
+                instrument triggers later. Defaults to zero for all
+                instruments.
+    timeout:    Maximum time in seconds to wait for each instrument to
+                complete its acquisition
+
+    Channels are merged in the order of hw_ifs. The time of the first sample
+    of each merged channel, relative to the reference trigger, is stored in
+    model.ch_t0. This is the pre-trigger start time reported by each
+    instrument plus its trigger offset (t0 = start_time + trigger_offset),
+    minus the part of AnalogChannel.time_skew not applied by the hardware.
+    """
+    def __init__(self, hw_ifs, model, trigger_offsets=None, timeout=10.0):
+        self.hw_ifs = hw_ifs
+        self.model = model
+        self.timeout = timeout
+        if trigger_offsets is None:
+            trigger_offsets = [0.0] * len(hw_ifs)
+        assert len(trigger_offsets) == len(hw_ifs), "One offset per instrument"
+        self.trigger_offsets = list(trigger_offsets)
+        n_total = sum(hw_if.n_channels for hw_if in hw_ifs)
+        assert n_total == len(model.ch_buffers), (
+                "Data model must have as many channels as all instruments")
+        # One thread per instrument
+        self.executor = ThreadPoolExecutor(
+                max_workers=len(hw_ifs), thread_name_prefix="instrument")
+        # All instruments are armed as closely in time as possible
+        self._arm_barrier = threading.Barrier(len(hw_ifs))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def _arm_one(self, hw_if):
+        self._arm_barrier.wait()
+        hw_if.arm()
+
+    def _pull_one(self, hw_if):
+        # Pulling right after arming would read nothing
+        if not hw_if.wait_complete(self.timeout):
+            return False
+        return hw_if._pull_data(run_callbacks=False)
+
+    def _run_all(self, function):
+        # Exceptions from worker threads are re-raised here by result()
+        futures = [self.executor.submit(function, i) for i in self.hw_ifs]
+        return [future.result() for future in futures]
+
+    def arm(self):
+        """Arm trigger of all instruments concurrently"""
+        self._arm_barrier.reset()
+        self._run_all(self._arm_one)
+
+    def pull_data(self):
+        """Download data of all instruments concurrently, merge channels
+        into the data model and notify it of the new frame.
+
+        Returns True if all instruments delivered data. Otherwise, e.g. on
+        timeout, no new frame is passed to the data model.
+        """
+        # Config and data callbacks are suppressed in the worker threads.
+        # cbX_config is shared by all HardwareInterface instances, so it is
+        # run once, from the calling (GUI) thread.
+        delivered = self._run_all(self._pull_one)
+        self.hw_ifs[0]._run_cbX_config()
+        if not all(delivered):
+            return False
+        self._merge()
+        self.model.on_new_frame(
+                [i for hw_if in self.hw_ifs for i in hw_if.raw_frames()])
+        return True
+
+    def acquire(self):
+        """Single-shot acquisition on all instruments.
+        Returns True if all instruments delivered data."""
+        self.arm()
+        return self.pull_data()
+
+    def _merge(self):
+        # Channel buffers are merged by reference, no sample data is copied
+        model = self.model
+        i = 0
+        for hw_if, trigger_offset in zip(self.hw_ifs, self.trigger_offsets):
+            # Includes the residual per-channel skew, see time_bases()
+            for ch, (sample_rate, t0) in zip(hw_if.ch, hw_if.time_bases()):
+                model.ch_buffers[i] = hw_if.ch_buffers[ch.index]
+                model.ch_sample_rate[i] = sample_rate
+                model.ch_t0[i] = t0 + trigger_offset
+                i += 1
+
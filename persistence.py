@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Persistence / waveform density display
+
+Each new frame is binned into a fixed size (time pixel x amplitude pixel)
+histogram with one scatter-add per chunk of samples. Memory usage depends on
+the screen resolution only, so any number of deep memory frames can be
+overlaid, similar to an analog phosphor display.
+"""
+import numpy as np
+
+
+class DensityAccumulator():
+    """Incremental 2D histogram of sample amplitude versus time position.
+
+    Init args:
+    n_time:     Number of time (horizontal) pixels
+    n_amp:      Number of amplitude (vertical) pixels
+    y_range:    Tuple of amplitude range (y_min, y_max) mapped to n_amp rows.
+                For raw ADC codes, this is in code units.
+    decay:      Factor applied to all counts before adding a new frame.
+                1.0 means infinite persistence. With decay, counts are kept
+                as float32 so that single hits fade out gradually instead of
+                being truncated to zero.
+    chunk_size: Number of samples binned at a time. This bounds the size of
+                temporary index arrays for deep memory frames.
+
+    Samples outside of y_range are counted in two guard rows which are not
+    part of the displayed image. Integer counts saturate instead of wrapping.
+    """
+    def __init__(self, n_time=1000, n_amp=256, y_range=(-1.0, 1.0),
+                 decay=1.0, chunk_size=2**20):
+        dtype = np.float32 if decay < 1.0 else np.uint32
+        self.hist = np.zeros((n_time, n_amp + 2), dtype=dtype)
+        self.y_range = y_range
+        self.decay = decay
+        self.chunk_size = chunk_size
+        self.n_frames = 0
+
+    def clear(self):
+        self.hist[...] = 0
+        self.n_frames = 0
+
+    def _row_index(self, y):
+        """Histogram row of each sample including the guard row offset"""
+        n_amp = self.hist.shape[1] - 2
+        y_min, y_max = self.y_range
+        scale = n_amp / (y_max - y_min)
+        if y.dtype == np.uint8:
+            # Raw 8-bit codes: Lookup table instead of float arithmetic
+            lut = np.floor((np.arange(256) - y_min) * scale)
+            lut = np.clip(lut, -1, n_amp).astype(np.intp) + 1
+            return lut[y]
+        rows = (y - y_min) * scale
+        np.floor(rows, out=rows)
+        # NaN, e.g. from math channels like CH1/CH2, goes to the lower guard
+        # row. Infinite values are clipped into the guard rows.
+        np.nan_to_num(rows, copy=False, nan=-1, posinf=n_amp, neginf=-1)
+        np.clip(rows, -1, n_amp, out=rows)
+        index = rows.astype(np.intp)
+        index += 1
+        return index
+
+    def add_frame(self, y):
+        """Bin all samples of one frame. The frame is mapped to the full time
+        axis, regardless of its number of samples.
+        """
+        n_samples = y.size
+        n_time, n_rows = self.hist.shape
+        if self.decay < 1.0:
+            self.hist *= np.float32(self.decay)
+        flat = self.hist.reshape(-1)
+        saturate = np.issubdtype(flat.dtype, np.integer)
+        for start in range(0, n_samples, self.chunk_size):
+            stop = min(start + self.chunk_size, n_samples)
+            index = self._row_index(y[start:stop])
+            # Time pixel column of each sample, integer arithmetic only
+            cols = np.arange(start, stop, dtype=np.intp)
+            cols *= n_time
+            cols //= n_samples
+            cols *= n_rows
+            index += cols
+            counts = np.bincount(index, minlength=flat.size)
+            if saturate:
+                np.minimum(counts, np.iinfo(flat.dtype).max - flat, out=counts)
+            np.add(flat, counts, out=flat, casting="unsafe")
+        self.n_frames += 1
+
+    def image(self, log_scale=True):
+        """Returns the density as uint8 image, shape (n_amp, n_time), with
+        the first row at the lowest amplitude. 0 means no hits.
+        """
+        counts = self.hist[:, 1:-1].T
+        peak = counts.max()
+        if peak == 0:
+            return np.zeros(counts.shape, dtype=np.uint8)
+        if log_scale:
+            # Rare events stay visible next to the dominant trace
+            levels = np.log1p(counts, dtype=np.float32) / np.log1p(peak)
+        else:
+            levels = counts / np.float32(peak)
+        image = np.ceil(levels * 255).astype(np.uint8)
+        return image
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Common interface of the plot widgets used by the main window
+
+Implementations:
+mplwidget.MplWidget:        Matplotlib Qt5Agg canvas, full-featured
+fastplotwidget.FastPlotWidget:
+                            QPainter with pre-allocated vertex buffers, built
+                            for high frame rates in continuous acquisition
+"""
+from PyQt5.QtWidgets import QWidget
+
+
+class PlotWidgetBase(QWidget):
+    """Plot widget interface.
+
+    Public members:
+    cursors:    List of four measurement cursors: two horizontal, two
+                vertical. Each has a set_enabled(activation) method, a
+                restore() method and a callback attribute which is called
+                with the activation state, e.g. a QCheckBox setChecked method.
+    """
+    cursors = []
+
+    def plot_new(self, time_span, channels, ydata, time_bases=None):
+        """Replace all traces by new sample data.
+
+        time_span:  Time span of the sample vectors in seconds
+        channels:   Per-channel active flags
+        ydata:      Sequence of per-channel sample vectors. These may be
+                    math_channels.MathChannel instances.
+        time_bases: Optional per-channel tuples (sample rate, time of first
+                    sample relative to the trigger), see
+                    DataModel.time_base(). If given, this replaces time_span
+                    and traces of merged instruments are drawn aligned.
+        """
+        raise NotImplementedError
+
+    def plot_density(self, image, extent):
+        """Show a waveform density (persistence) image.
+
+        image:      uint8 array of shape (n_amp, n_time), first row at the
+                    lowest amplitude, 0 meaning no hits.
+                    See persistence.DensityAccumulator.image()
+        extent:     Tuple (x0, x1, y0, y1) of the image in data coordinates
+        """
+        raise NotImplementedError
+
+    def plot_annotations(self, t_start, t_stop, text, y):
+        """Overlay decoded protocol annotations, e.g. from protocol_decode.
+
+        t_start, t_stop:    Arrays of annotation time spans in seconds
+        text:               Array of annotation texts
+        y:                  Vertical position in data coordinates
+        Empty arrays remove all annotations.
+        """
+        raise NotImplementedError
+
+    def make_toolbar(self, parent):
+        """Returns a QToolBar for zooming and panning this plot"""
+        raise NotImplementedError
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Digital threshold and serial protocol decoding (UART, SPI, I2C)
+
+Analog records, preferably raw ADC codes, are thresholded with hysteresis
+and reduced to lists of edge positions in cache-sized chunks. Decoders then
+only work on these much shorter edge lists: Bit levels at arbitrary sample
+positions are looked up with one vectorized binary search.
+
+All positions are sample indices. Decoders return Annotations: parallel
+arrays of the sample index range (start, stop) of each decoded word, its
+value and a display text.
+"""
+from collections import namedtuple
+import numpy as np
+
+# positions:        Sample indices where the level changes, i.e. the first
+#                   sample having the new level
+# initial_level:    Level of the first sample, 0 or 1
+Edges = namedtuple("Edges", "positions initial_level n_samples")
+Annotations = namedtuple("Annotations", "start stop value text")
+
+_HEX = np.array([f"{i:02X}" for i in range(256)])
+
+
+def find_edges(x, low, high, chunk_size=2**20):
+    """Threshold x with hysteresis and return the Edges of the digital signal.
+
+    Samples >= high are level 1, samples <= low are level 0, samples in
+    between keep the previous level. Works on raw integer codes as well as on
+    physical values, without type conversion of the input.
+    """
+    index = np.arange(min(chunk_size, x.size))
+    positions = []
+    initial = state = None
+    for start in range(0, x.size, chunk_size):
+        chunk = x[start:start+chunk_size]
+        is_high = chunk >= high
+        defined = chunk <= low
+        defined |= is_high
+        # Index of the last defined sample for each sample, -1 for none yet
+        last = np.where(defined, index[:chunk.size], -1)
+        np.maximum.accumulate(last, out=last)
+        if state is None:
+            if last[-1] < 0:
+                continue
+            # Samples before the first defined one get its level
+            initial = state = bool(is_high[np.argmax(defined)])
+        digital = is_high[np.maximum(last, 0)]
+        digital[last < 0] = state
+        if start > 0 and digital[0] != state:
+            positions.append(np.array([start]))
+        positions.append(np.flatnonzero(digital[1:] != digital[:-1]) + 1 + start)
+        state = digital[-1]
+    positions = np.concatenate(positions) if positions else np.empty(0, np.intp)
+    return Edges(positions, int(bool(initial)), x.size)
+
+
+def level_at(edges, positions):
+    """Digital levels (0 or 1) at arbitrary sample positions"""
+    n_edges = np.searchsorted(edges.positions, positions, side="right")
+    return edges.initial_level ^ (n_edges & 1)
+
+
+def levels_after(edges):
+    """Level following each edge"""
+    return edges.initial_level ^ ((np.arange(edges.positions.size) + 1) & 1)
+
+
+def _hex_text(values, n_bits=8):
+    # Table lookup instead of formatting each value
+    if n_bits <= 8:
+        return _HEX[values].astype("U16")
+    return np.array([f"{i:X}" for i in values.tolist()], dtype="U16")
+
+
+def _mark(text, mask, suffix):
+    """Append suffix to the texts selected by the boolean mask"""
+    text[mask] = np.char.add(text[mask], suffix)
+
+
+def _concatenate(annotations):
+    if not annotations:
+        empty = np.empty(0, dtype=np.int64)
+        return Annotations(empty, empty, empty, np.empty(0, dtype="U16"))
+    annotations = [np.concatenate(i) for i in zip(*annotations)]
+    order = np.argsort(annotations[0], kind="stable")
+    return Annotations(*(i[order] for i in annotations))
+
+
+def _bits_to_values(bits, msb_first):
+    n_bits = bits.shape[-1]
+    weights = 1 << np.arange(n_bits, dtype=np.int64)
+    if msb_first:
+        weights = weights[::-1]
+    return bits.astype(np.int64) @ weights
+
+
+def decode_uart(rx, sample_rate, baud, n_bits=8, parity=None, idle_high=True,
+                msb_first=False):
+    """Decode asynchronous serial frames from the Edges of the RX line.
+
+    parity:     None, "even" or "odd"
+    Returns Annotations. Frames with framing or parity errors are marked
+    "FE" or "PE" in their text.
+    """
+    spb = sample_rate / baud
+    invert = 0 if idle_high else 1
+    n_frame = 1 + n_bits + (parity is not None) + 1
+    falls = rx.positions[(levels_after(rx) ^ invert) == 0]
+    # Falling edges inside a frame are data bits. Following the index of the
+    # first falling edge after each frame is the only sequential step.
+    next_fall = np.searchsorted(falls, falls + (n_frame - 0.5) * spb).tolist()
+    selected = []
+    i = 0
+    while i < len(next_fall):
+        selected.append(i)
+        i = next_fall[i]
+    starts = falls[selected].astype(np.int64)
+    starts = starts[starts + n_frame * spb <= rx.n_samples]
+    # Bit centers of all frames at once: start, data, parity, stop
+    centers = starts[:, np.newaxis] + (np.arange(n_frame) + 0.5) * spb
+    levels = level_at(rx, centers.astype(np.int64)) ^ invert
+    # Start bit glitches shorter than half a bit are no frames
+    valid = levels[:, 0] == 0
+    starts, levels = starts[valid], levels[valid]
+    data = levels[:, 1:1+n_bits]
+    values = _bits_to_values(data, msb_first)
+    text = _hex_text(values, n_bits)
+    _mark(text, levels[:, -1] == 0, " FE")
+    if parity is not None:
+        ones = data.sum(axis=1) + levels[:, 1+n_bits]
+        _mark(text, ones % 2 != (0 if parity == "even" else 1), " PE")
+    stops = starts + int(round(n_frame * spb))
+    return Annotations(starts, stops, values, text)
+
+
+def decode_spi(clk, mosi, miso=None, cs=None, cpol=0, cpha=0, n_bits=8,
+               msb_first=True):
+    """Decode SPI words from the Edges of the clock, data and optional
+    active-low chip select lines.
+
+    Without chip select, words are counted from the first clock edge.
+    Returns Annotations. Values are MOSI words, or (MOSI, MISO) rows if
+    miso is given.
+    """
+    # Data is sampled on the rising clock edge for SPI modes 0 and 3
+    sample_level = 1 if cpol == cpha else 0
+    sample_pos = clk.positions[levels_after(clk) == sample_level]
+    if cs is not None:
+        sample_pos = sample_pos[level_at(cs, sample_pos) == 0]
+        cs_falls = cs.positions[levels_after(cs) == 0]
+        segment = np.searchsorted(cs_falls, sample_pos, side="right")
+        bounds = np.flatnonzero(np.diff(segment)) + 1
+    else:
+        bounds = np.empty(0, dtype=np.intp)
+    bounds = np.concatenate(([0], bounds, [sample_pos.size]))
+    # Bit sample positions of all complete words
+    words = [sample_pos[a:a + (b-a)//n_bits*n_bits].reshape(-1, n_bits)
+             for a, b in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+    pos = np.concatenate(words) if words else np.empty((0, n_bits), np.intp)
+    values = _bits_to_values(level_at(mosi, pos), msb_first)
+    text = _hex_text(values, n_bits)
+    if miso is not None:
+        miso_values = _bits_to_values(level_at(miso, pos), msb_first)
+        text = np.char.add(np.char.add(text, "/"),
+                           _hex_text(miso_values, n_bits))
+        values = np.column_stack((values, miso_values))
+    return Annotations(pos[:, 0], pos[:, -1], values, text)
+
+
+def decode_i2c(scl, sda):
+    """Decode I2C transfers from the Edges of the SCL and SDA lines.
+
+    Returns Annotations: "S" and "P" for start and stop conditions with
+    value -1, address bytes as e.g. "A50 W" and data bytes as hex. Value of
+    an address annotation is the 7-bit address. Not acknowledged bytes are
+    marked "NAK".
+    """
+    scl_high = level_at(scl, sda.positions - 1) == 1
+    sda_new = levels_after(sda)
+    starts = sda.positions[scl_high & (sda_new == 0)]
+    stops = sda.positions[scl_high & (sda_new == 1)]
+    bit_pos = scl.positions[levels_after(scl) == 1]
+    conditions = np.concatenate((starts, stops, [sda.n_samples]))
+    conditions.sort()
+    # Bits between each start condition and the next start or stop condition
+    ends = conditions[np.searchsorted(conditions, starts, side="right")]
+    first = np.searchsorted(bit_pos, starts)
+    n_bytes = (np.searchsorted(bit_pos, ends) - first) // 9
+    bytes_pos = [bit_pos[a:a + n*9].reshape(n, 9)
+                 for a, n in zip(first.tolist(), n_bytes.tolist())]
+    pos = np.concatenate(bytes_pos) if bytes_pos else np.empty((0, 9), np.intp)
+    frame = level_at(sda, pos)
+    values = _bits_to_values(frame[:, :8], msb_first=True)
+    # The first byte after a start condition is address and R/W bit
+    is_address = np.zeros(values.size, dtype=bool)
+    is_address[(np.cumsum(n_bytes) - n_bytes)[n_bytes > 0]] = True
+    text = _hex_text(values)
+    address = values[is_address] >> 1
+    text[is_address] = np.char.add(
+            np.char.add("A", _hex_text(address)),
+            np.where(values[is_address] & 1, " R", " W"))
+    values[is_address] = address
+    _mark(text, frame[:, 8] == 1, " NAK")
+    n_start, n_stop = starts.size, stops.size
+    return _concatenate([
+            (starts, starts, np.full(n_start, -1), np.full(n_start, "S", "U16")),
+            (stops, stops, np.full(n_stop, -1), np.full(n_stop, "P", "U16")),
+            (pos[:, 0], pos[:, 8], values, text),
+            ])
@@ -35,18 +35,20 @@ class Rigol_DS1054Z():
     def idn(self):
         return self.dev.query("*IDN?")
     
-    def read_samples(self, ch, n_samples=24*10**6):
+    def read_samples(self, ch, n_samples=24*10**6, dtype=np.float64):
         """Reads all samples acquired for the specified channel and returns a
         numpy.ndarray vector with scaled and offset-corrected physical units.
 
-        Usually this is samples in volts.
+        Usually this is samples in volts. dtype is the floating point type of
+        the result, e.g. Config.float_precision. For new code, see
+        scope_drivers.RigolDS1000Z.
         """
         self.dev.write("stop")
         # Wait for acquisition to finish
         self.dev.query('*OPC?')
         # Set output format to int16, little endian
         self.dev.write("waveform:source channel{ch};mode raw;format byte")
-        samples_raw = np.zeros(n_samples)
+        samples_raw = np.zeros(n_samples, dtype=dtype)
         for start, stop in slice_range(1, n_samples, 750000):
             self.dev.write(f"waveform:start {start};:waveform:stop {stop}")
             samples_raw[start-1:stop] = self.dev.query_binary_values(
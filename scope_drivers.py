@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Native binary waveform download for supported oscilloscopes
+
+python-ivi is still used for all instrument settings, but its
+fetch_waveform() creates one Python float object per sample, which does not
+scale to deep memory acquisitions. The drivers in this module read the raw
+SCPI binary blocks directly into numpy arrays instead.
+"""
+import numpy as np
+from iterators_generators import slice_range
+
+
+class NativeDriver():
+    """Base class for vendor-specific binary waveform download.
+
+    Init args:
+    dev:        PyVISA resource, usually the one already opened by python-ivi,
+                i.e. ivi_driver._interface.instrument
+    n_channels: Number of analog channels of the instrument
+
+    Subclasses implement read_raw() and get_scaling(). Raw sample codes are
+    converted to physical units as: samples = raw*gain + offset
+    """
+    # Sample format of the raw binary data as sent by the instrument
+    raw_dtype = np.uint8
+    # PyVISA / struct format string matching raw_dtype
+    raw_format = "B"
+
+    def __init__(self, dev, n_channels=4):
+        self.dev = dev
+        self.n_channels = n_channels
+
+    @classmethod
+    def from_ivi_driver(cls, ivi_driver, n_channels=4):
+        """Create native driver sharing the PyVISA resource of an existing
+        python-ivi driver instance.
+
+        Returns None if the ivi driver does not use a PyVISA interface.
+        """
+        dev = getattr(ivi_driver._interface, "instrument", None)
+        if dev is None:
+            print("No PyVISA interface, native waveform download disabled")
+            return None
+        return cls(dev, n_channels)
+
+    def idn(self):
+        return self.dev.query("*IDN?")
+
+    def _query_block(self, command):
+        # With container=np.array, PyVISA wraps the received binary block
+        # using np.frombuffer, i.e. no Python objects are created per sample.
+        return self.dev.query_binary_values(
+                command,
+                datatype=self.raw_format,
+                header_fmt="ieee",
+                is_big_endian=False,
+                container=np.array)
+
+    def read_raw(self, ch, n_samples, out=None):
+        """Reads n_samples raw ADC codes of channel number ch (1-based)
+
+        If out is given, this must be an array of raw_dtype with at least
+        n_samples elements. Returns an array of raw sample codes.
+        """
+        raise NotImplementedError
+
+    def get_scaling(self, ch):
+        """Returns a tuple (gain, offset) to convert raw codes of channel
+        number ch (1-based) into physical units
+        """
+        raise NotImplementedError
+
+    def read_samples(self, ch, n_samples, out=None, dtype=np.float64):
+        """Reads n_samples samples of channel number ch (1-based) and returns
+        a numpy.ndarray vector with scaled and offset-corrected physical units.
+
+        If out is given, samples are written into the leading part of this
+        pre-allocated array and a view of the valid samples is returned.
+        Otherwise, a new array of floating point type dtype is returned.
+        """
+        raw = self.read_raw(ch, n_samples)
+        return self.scale_samples(raw, *self.get_scaling(ch), out=out,
+                                  dtype=dtype)
+
+    @staticmethod
+    def scale_samples(raw, gain, offset, out=None, dtype=np.float64):
+        """Returns raw codes converted to physical units, see read_samples()
+        """
+        if out is None:
+            out = np.empty(raw.size, dtype=dtype)
+        else:
+            out = out[:raw.size]
+        # In-place operations, no full-length temporaries
+        np.multiply(raw, gain, out=out, casting="same_kind")
+        out += offset
+        return out
+
+
+class RigolDS1000Z(NativeDriver):
+    """Native waveform download for Rigol DS1000Z series, e.g. DS1054Z and
+    DS1104Z.
+
+    Reading more than 1200 samples needs the instrument in STOP state.
+    """
+    raw_dtype = np.uint8
+    raw_format = "B"
+    # Programming manual: Maximum number of points per read in BYTE format
+    chunk_size = 250000
+
+    def read_raw(self, ch, n_samples, out=None):
+        if out is None:
+            out = np.empty(n_samples, dtype=self.raw_dtype)
+        # Wait for acquisition to finish
+        self.dev.query("*OPC?")
+        self.dev.write(f"waveform:source channel{ch};mode raw;format byte")
+        for start, stop in slice_range(1, n_samples, self.chunk_size):
+            self.dev.write(f"waveform:start {start};:waveform:stop {stop}")
+            out[start-1:stop] = self._query_block("waveform:data?")
+        return out[:n_samples]
+
+    def get_scaling(self, ch):
+        self.dev.write(f"waveform:source channel{ch}")
+        # format, type, points, count, xincrement, xorigin, xreference,
+        # yincrement, yorigin, yreference
+        preamble = self.dev.query_ascii_values("waveform:preamble?")
+        y_increment, y_origin, y_reference = preamble[7:10]
+        return y_increment, -(y_origin + y_reference) * y_increment
+
+
+class RohdeSchwarzRTH(NativeDriver):
+    """Native waveform download for Rohde & Schwarz RTH1002 and RTH1004
+    """
+    raw_dtype = np.int16
+    raw_format = "h"
+
+    def read_raw(self, ch, n_samples=None, out=None):
+        # The RTH always transfers the complete record
+        self.dev.write("FORM INT,16;:FORM:BORD LSBF")
+        # Wait for acquisition to finish
+        self.dev.query("*OPC?")
+        samples_raw = self._query_block(f"CHAN{ch}:DATA?")
+        if out is None:
+            return samples_raw
+        out[:samples_raw.size] = samples_raw
+        return out[:samples_raw.size]
+
+    def get_scaling(self, ch):
+        # See programming manual for the RTH series oscilloscope: Channel
+        # offset can be entered numerically in physical units or by setting a
+        # vertical shift in terms of grid divisions
+        scale, position, offset = (self.dev.query_ascii_values(i)[0] for i in (
+                f"CHAN{ch}:SCAL?", f"CHAN{ch}:POS?", f"CHAN{ch}:OFFS?"))
+        return scale*8/2**16, offset - position*scale
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Publication of acquisition frames in named shared memory
+
+The GUI process publishes each new frame into a ring of slots in shared
+memory. External processes, e.g. a Jupyter kernel, attach a FrameSubscriber
+and map the latest frame as numpy arrays without copying, pickling or
+re-downloading the data from the instrument.
+
+Example for an external process:
+    sub = FrameSubscriber("hdscope")
+    frame = sub.wait()
+    ch1 = frame.channels[0]  # Zero-copy view into shared memory
+"""
+import time
+import numpy as np
+from collections import namedtuple
+from multiprocessing import shared_memory, resource_tracker
+
+_MAGIC = 0x6864_7363_6f70_6501
+# Fixed part of the metadata segment
+_header_dtype = np.dtype([
+        ("magic", "<u8"),
+        # Sequence number of the latest completely written frame
+        ("seq", "<u8"),
+        # Sequence number of the frame currently being written
+        ("write_seq", "<u8"),
+        ("n_slots", "<u4"),
+        ("n_channels", "<u4"),
+        ("n_samples_max", "<u8"),
+        ("dtype", "S8"),
+        ])
+
+Frame = namedtuple("Frame", "seq channels sample_rate t0")
+
+
+def _slot_dtype(n_channels):
+    # Per-slot frame metadata, following the fixed header
+    return np.dtype([
+            ("seq", "<u8"),
+            ("n_samples", "<u8", (n_channels,)),
+            ("sample_rate", "<f8", (n_channels,)),
+            ("t0", "<f8", (n_channels,)),
+            ])
+
+
+def _attach(name):
+    """Attach to an existing segment without taking over its lifetime"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 registers attached segments with the resource tracker,
+        # which would unlink them when this process exits.
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class FramePublisher():
+    """Owner of the shared memory segments, used by the GUI process.
+
+    Init args:
+    name:           Base name of the shared memory segments
+    n_channels:     Number of channels per frame
+    n_samples_max:  Maximum number of samples per channel
+    dtype:          Sample data type
+    n_slots:        Number of frames kept in the ring. A subscriber's frame
+                    stays valid until n_slots newer frames are published.
+
+    Beware each slot takes n_channels*n_samples_max*itemsize bytes of RAM.
+    """
+    def __init__(self, name, n_channels, n_samples_max, dtype=np.float64,
+                 n_slots=2):
+        dtype = np.dtype(dtype)
+        slot_dtype = _slot_dtype(n_channels)
+        self._meta_shm = shared_memory.SharedMemory(
+                name=f"{name}_meta", create=True,
+                size=_header_dtype.itemsize + n_slots*slot_dtype.itemsize)
+        self._data_shm = shared_memory.SharedMemory(
+                name=f"{name}_data", create=True,
+                size=n_slots*n_channels*n_samples_max*dtype.itemsize)
+        self.header = np.ndarray((), _header_dtype, buffer=self._meta_shm.buf)
+        self.slots = np.ndarray((n_slots,), slot_dtype,
+                                buffer=self._meta_shm.buf,
+                                offset=_header_dtype.itemsize)
+        self.data = np.ndarray((n_slots, n_channels, n_samples_max), dtype,
+                               buffer=self._data_shm.buf)
+        self.slots[...] = 0
+        self.header["seq"] = 0
+        self.header["write_seq"] = 0
+        self.header["n_slots"] = n_slots
+        self.header["n_channels"] = n_channels
+        self.header["n_samples_max"] = n_samples_max
+        self.header["dtype"] = dtype.str.encode()
+        # Written last, subscribers check this before reading the header
+        self.header["magic"] = _MAGIC
+
+    def publish(self, ch_buffers, sample_rate, t0):
+        """Copy one frame into the next ring slot and notify subscribers.
+
+        ch_buffers:     Sequence of n_channels sample vectors
+        sample_rate:    Per-channel sample rate
+        t0:             Per-channel time of first sample relative to trigger
+        """
+        seq = int(self.header["seq"]) + 1
+        slot = seq % len(self.slots)
+        # Subscribers still holding the frame previously in this slot can
+        # detect it is being overwritten
+        self.header["write_seq"] = seq
+        for i, samples in enumerate(ch_buffers):
+            n = min(samples.size, self.data.shape[2])
+            self.data[slot, i, :n] = samples[:n]
+            self.slots[slot]["n_samples"][i] = n
+        self.slots[slot]["sample_rate"] = sample_rate
+        self.slots[slot]["t0"] = t0
+        self.slots[slot]["seq"] = seq
+        # Notification: Subscribers poll this sequence number
+        self.header["seq"] = seq
+        return seq
+
+    def close(self):
+        self.header = self.slots = self.data = None
+        for shm in (self._meta_shm, self._data_shm):
+            shm.close()
+            shm.unlink()
+
+
+class FrameSubscriber():
+    """Read-only access to frames published by a FramePublisher.
+
+    Init args:
+    name:   Base name of the shared memory segments
+    """
+    def __init__(self, name):
+        self._meta_shm = _attach(f"{name}_meta")
+        self.header = np.ndarray((), _header_dtype, buffer=self._meta_shm.buf)
+        assert self.header["magic"] == _MAGIC, "Not a hdscope frame segment"
+        n_slots = int(self.header["n_slots"])
+        n_channels = int(self.header["n_channels"])
+        n_samples_max = int(self.header["n_samples_max"])
+        self.slots = np.ndarray((n_slots,), _slot_dtype(n_channels),
+                                buffer=self._meta_shm.buf,
+                                offset=_header_dtype.itemsize)
+        self._data_shm = _attach(f"{name}_data")
+        self.data = np.ndarray((n_slots, n_channels, n_samples_max),
+                               np.dtype(self.header["dtype"].item().decode()),
+                               buffer=self._data_shm.buf)
+        self.data.flags.writeable = False
+
+    @property
+    def seq(self):
+        """Sequence number of the latest published frame, 0 if none yet"""
+        return int(self.header["seq"])
+
+    def latest(self):
+        """Returns the latest frame, or None if nothing was published yet.
+
+        Channel sample vectors are views into shared memory and are valid
+        until is_valid() returns False.
+        """
+        seq = self.seq
+        if seq == 0:
+            return None
+        slot = self.slots[seq % len(self.slots)]
+        channels = [self.data[seq % len(self.slots), i, :n]
+                    for i, n in enumerate(slot["n_samples"])]
+        return Frame(seq, channels, slot["sample_rate"].copy(),
+                     slot["t0"].copy())
+
+    def is_valid(self, frame):
+        """False if the frame slot was overwritten by newer frames"""
+        return int(self.header["write_seq"]) < frame.seq + len(self.slots)
+
+    def wait(self, last_seq=None, timeout=None, poll_interval=0.001):
+        """Wait for a frame newer than last_seq (default: current frame)
+
+        Returns the new frame, or None on timeout.
+        """
+        if last_seq is None:
+            last_seq = self.seq
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.seq <= last_seq:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(poll_interval)
+        return self.latest()
+
+    def close(self):
+        self.header = self.slots = self.data = None
+        self._meta_shm.close()
+        self._data_shm.close()